@@ -23,11 +23,15 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 ##############################################################################
 import collections
+import ctypes
+import ctypes.util
 import errno
+import fcntl
+import fnmatch
 import hashlib
-import fileinput
 import glob
 import grp
+import multiprocessing
 import numbers
 import os
 import pwd
@@ -36,11 +40,14 @@ import shutil
 import stat
 import sys
 import tempfile
+import threading
+import time
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 
 import six
 from llnl.util import tty
-from llnl.util.lang import dedupe
+from llnl.util.lang import dedupe, memoized
 from spack.util.executable import Executable
 
 __all__ = [
@@ -92,6 +99,28 @@ def same_path(path1, path2):
     return norm1 == norm2
 
 
+#: Size of the buffers used to read and write files in ``filter_file``
+_filter_buffer_size = 1024 * 1024
+
+#: Files up to this size are filtered in memory by ``filter_file``
+_filter_in_memory_size = 64 * 1024 * 1024
+
+#: Matches sed-like back-references (``\1``, ``\2``, etc.) in replacements
+_backref_regex = re.compile(r'\\([1-9])')
+
+
+@memoized
+def _compile_filter_regex(regex, string):
+    """Compiles the regex used by ``filter_file``.
+
+    Packages often filter many files with the same regex (e.g. through
+    ``FileFilter``), so keep the compiled patterns around.
+    """
+    if string:
+        regex = re.escape(regex)
+    return re.compile(regex)
+
+
 def filter_file(regex, repl, *filenames, **kwargs):
     r"""Like sed, but uses python regular expressions.
 
@@ -126,16 +155,15 @@ def filter_file(regex, repl, *filenames, **kwargs):
         def replace_groups_with_groupid(m):
             def groupid_to_group(x):
                 return m.group(int(x.group(1)))
-            return re.sub(r'\\([1-9])', groupid_to_group, unescaped)
+            return _backref_regex.sub(groupid_to_group, unescaped)
         repl = replace_groups_with_groupid
 
-    if string:
-        regex = re.escape(regex)
+    pattern = _compile_filter_regex(regex, string)
 
     for filename in filenames:
 
         msg = 'FILTER FILE: {0} [replacing "{1}"]'
-        tty.debug(msg.format(filename, regex))
+        tty.debug(msg.format(filename, pattern.pattern))
 
         backup_filename = filename + "~"
 
@@ -146,22 +174,55 @@ def filter_file(regex, repl, *filenames, **kwargs):
 
         # Create backup file. Don't overwrite an existing backup
         # file in case this file is being filtered multiple times.
-        if not os.path.exists(backup_filename):
+        if backup and not os.path.exists(backup_filename):
             shutil.copy(filename, backup_filename)
 
         try:
-            for line in fileinput.input(filename, inplace=True):
-                print(re.sub(regex, repl, line.rstrip('\n')))
-        except BaseException:
-            # clean up the original file on failure.
-            shutil.move(backup_filename, filename)
-            raise
-
+            _filter_single_file(filename, pattern, repl)
         finally:
             if not backup and os.path.exists(backup_filename):
                 os.remove(backup_filename)
 
 
+def _filter_single_file(filename, pattern, repl):
+    """Filters each line of a file through a compiled regex.
+
+    See ``filter_file`` for the meaning of the arguments.
+    """
+    with open(filename, 'r', _filter_buffer_size) as original:
+        if os.fstat(original.fileno()).st_size <= _filter_in_memory_size:
+            # Filter small files in memory, and leave them alone if
+            # nothing changed
+            content = original.read()
+            lines = content.split('\n')
+            if not lines[-1]:
+                lines.pop()
+            filtered = ''.join(
+                pattern.sub(repl, line) + '\n' for line in lines)
+            if filtered == content:
+                return
+        else:
+            filtered = None
+
+        # Write the filtered file next to the original one and move it in
+        # place at the end: the original is left untouched on failure.
+        tmp_fd, tmp_filename = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(filename)))
+        try:
+            with os.fdopen(tmp_fd, 'w', _filter_buffer_size) as output:
+                if filtered is not None:
+                    output.write(filtered)
+                else:
+                    for line in original:
+                        output.write(
+                            pattern.sub(repl, line.rstrip('\n')) + '\n')
+            shutil.copymode(filename, tmp_filename)
+            os.rename(tmp_filename, filename)
+        except BaseException:
+            os.remove(tmp_filename)
+            raise
+
+
 class FileFilter(object):
     """Convenience class for calling ``filter_file`` a lot."""
 
@@ -205,23 +266,38 @@ def change_sed_delimiter(old_delim, new_delim, *filenames):
     double_quoted = r'"s@((?:\\"|[^@"])*)@((?:\\"|[^"])*)@[gIp]?"'
     double_quoted = double_quoted.replace('@', old_delim)
 
-    repl = r's@\1@\2@g'
-    repl = repl.replace('@', new_delim)
+    # Match all kinds of sed commands with a single regex, so that each
+    # file is filtered only once. The name of the alternative that
+    # matched tells which quotes need to be restored around the command.
+    sed_commands = '(?P<unquoted>{0})|(?P<single>{1})|(?P<double>{2})'.format(
+        whole_lines, single_quoted, double_quoted)
+    quotes = {'unquoted': '', 'single': "'", 'double': '"'}
+
+    def replace_delimiter(match):
+        # Groups of a command follow the group of the matching alternative
+        i = match.lastindex
+        command = new_delim.join(
+            ('s', match.group(i + 1), match.group(i + 2), 'g'))
+        quote = quotes[match.lastgroup]
+        return quote + command + quote
 
     for f in filenames:
-        filter_file(whole_lines, repl, f)
-        filter_file(single_quoted, "'%s'" % repl, f)
-        filter_file(double_quoted, '"%s"' % repl, f)
+        filter_file(sed_commands, replace_delimiter, f)
 
 
-def set_install_permissions(path):
-    """Set appropriate permissions on the installed file."""
+def set_install_permissions(path, path_stat=None):
+    """Set appropriate permissions on the installed file.
+
+    If already known, the result of ``os.lstat(path)`` can be passed as
+    ``path_stat`` to avoid calling it again.
+    """
+    mode = (path_stat or os.lstat(path)).st_mode
     # If this points to a file maintained in a Spack prefix, it is assumed that
     # this function will be invoked on the target. If the file is outside a
     # Spack-maintained prefix, the permissions should not be modified.
-    if os.path.islink(path):
+    if stat.S_ISLNK(mode):
         return
-    if os.path.isdir(path):
+    if stat.S_ISDIR(mode):
         os.chmod(path, 0o755)
     else:
         os.chmod(path, 0o644)
@@ -238,17 +314,31 @@ def group_ids(uid=None):
     """
     if uid is None:
         uid = os.getuid()
+    return list(_group_ids(uid))
+
+
+@memoized
+def _group_ids(uid):
+    """Memoized implementation of ``group_ids``.
+
+    Scanning all the groups can be slow (e.g. with LDAP), and group
+    membership is not expected to change while Spack is running.
+    """
     user = pwd.getpwuid(uid).pw_name
-    return [g.gr_gid for g in grp.getgrall() if user in g.gr_mem]
+    return tuple(g.gr_gid for g in grp.getgrall() if user in g.gr_mem)
 
 
-def copy_mode(src, dest):
+def copy_mode(src, dest, src_stat=None):
     """Set the mode of dest to that of src unless it is a link.
+
+    If already known, the result of ``os.stat(src)`` can be passed as
+    ``src_stat`` to avoid calling it again.
     """
-    if os.path.islink(dest):
+    # dest is not a link past this point, so lstat gives its mode
+    dest_mode = os.lstat(dest).st_mode
+    if stat.S_ISLNK(dest_mode):
         return
-    src_mode = os.stat(src).st_mode
-    dest_mode = os.stat(dest).st_mode
+    src_mode = (src_stat or os.stat(src)).st_mode
     if src_mode & stat.S_IXUSR:
         dest_mode |= stat.S_IXUSR
     if src_mode & stat.S_IXGRP:
@@ -258,14 +348,89 @@ def copy_mode(src, dest):
     os.chmod(dest, dest_mode)
 
 
-def unset_executable_mode(path):
-    mode = os.stat(path).st_mode
+def unset_executable_mode(path, path_stat=None):
+    mode = (path_stat or os.stat(path)).st_mode
     mode &= ~stat.S_IXUSR
     mode &= ~stat.S_IXGRP
     mode &= ~stat.S_IXOTH
     os.chmod(path, mode)
 
 
+#: Size of the buffer used to copy files when they can't be cloned
+_copy_buffer_size = 1024 * 1024
+
+#: ioctl request used on Linux to clone a file (FICLONE)
+_FICLONE = 0x40049409
+
+
+def _encode_path(path):
+    """Returns *path* as bytes, to be passed to C functions."""
+    if isinstance(path, six.text_type):
+        return path.encode('utf-8')
+    return path
+
+
+@memoized
+def _darwin_clonefile():
+    """Returns the ``clonefile`` function of libSystem, or None if the
+    running macOS doesn't provide it.
+    """
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    return getattr(libc, 'clonefile', None)
+
+
+def _clone_file(src, dest):
+    """Tries to make *dest* a copy-on-write clone of *src*.
+
+    On filesystems that support it (e.g. btrfs, XFS or APFS) this doesn't
+    move any data, no matter how big the file is.
+
+    *src* must be a regular file, distinct from *dest*.
+
+    Returns:
+        bool: True if the file was cloned, False otherwise
+    """
+    try:
+        if sys.platform.startswith('linux'):
+            with open(src, 'rb') as s:
+                with open(dest, 'wb') as d:
+                    fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            return True
+
+        if sys.platform == 'darwin' and not os.path.lexists(dest):
+            clonefile = _darwin_clonefile()
+            if clonefile is not None:
+                return clonefile(_encode_path(src), _encode_path(dest), 0) == 0
+    except (IOError, OSError):
+        # Filesystem doesn't support cloning, or files are on different
+        # filesystems. Any real error will be raised by the fallback copy.
+        pass
+
+    return False
+
+
+def _copyfile(src, dest):
+    """Like ``shutil.copyfile``, but clones *src* if possible."""
+    # Let shutil deal with copying a file onto itself, or with copying
+    # something that is not a regular file
+    if not os.path.isfile(src) or (
+            os.path.exists(dest) and os.path.samefile(src, dest)):
+        shutil.copyfile(src, dest)
+
+    elif _clone_file(src, dest):
+        return
+
+    elif sys.version_info >= (3, 8):
+        # shutil.copyfile already copies in the kernel (e.g. with sendfile)
+        shutil.copyfile(src, dest)
+
+    else:
+        # Older versions of shutil.copyfile copy through small buffers
+        with open(src, 'rb') as fsrc:
+            with open(dest, 'wb') as fdst:
+                shutil.copyfileobj(fsrc, fdst, _copy_buffer_size)
+
+
 def copy(src, dest, _permissions=False):
     """Copies the file *src* to the file or directory *dest*.
 
@@ -286,7 +451,8 @@ def copy(src, dest, _permissions=False):
     if os.path.isdir(dest):
         dest = join_path(dest, os.path.basename(src))
 
-    shutil.copy(src, dest)
+    _copyfile(src, dest)
+    shutil.copymode(src, dest)
 
     if _permissions:
         set_install_permissions(dest)
@@ -320,7 +486,15 @@ def resolve_link_target_relative_to_the_link(l):
     return os.path.join(link_dir, target)
 
 
-def copy_tree(src, dest, symlinks=True, ignore=None, _permissions=False):
+#: Number of threads used by ``copy_tree`` to copy files
+_copy_tree_jobs = min(32, 4 * multiprocessing.cpu_count())
+
+#: Minimum number of files for ``copy_tree`` to start a pool of threads
+_copy_tree_parallel_threshold = 64
+
+
+def copy_tree(src, dest, symlinks=True, ignore=None, _permissions=False,
+              parallel=True):
     """Recursively copy an entire directory tree rooted at *src*.
 
     If the destination directory *dest* does not already exist, it will
@@ -340,6 +514,7 @@ def copy_tree(src, dest, symlinks=True, ignore=None, _permissions=False):
         symlinks (bool): whether or not to preserve symlinks
         ignore (function): function indicating which files to ignore
         _permissions (bool): for internal use only
+        parallel (bool): whether to copy files using a pool of threads
     """
     if _permissions:
         tty.debug('Installing {0} to {1}'.format(src, dest))
@@ -351,35 +526,67 @@ def copy_tree(src, dest, symlinks=True, ignore=None, _permissions=False):
     src = os.path.abspath(src)
     dest = os.path.abspath(dest)
 
-    for s, d in traverse_tree(src, dest, order='pre',
-                              follow_symlinks=not symlinks,
-                              ignore=ignore,
-                              follow_nonexisting=True):
-        if os.path.islink(s):
-            link_target = resolve_link_target_relative_to_the_link(s)
+    def copy_entry(s, d, s_stat):
+        mode = s_stat.st_mode
+        if stat.S_ISLNK(mode):
             if symlinks:
                 target = os.readlink(s)
-                if os.path.isabs(target):
-                    new_target = re.sub(src, dest, target)
+                # Redirect absolute links pointing into src to dest. The
+                # paths are literal, so don't use them as regexes.
+                if target == src or target.startswith(src + os.sep):
+                    new_target = dest + target[len(src):]
                     if new_target != target:
                         tty.debug("Redirecting link {0} to {1}"
                                   .format(target, new_target))
                         target = new_target
 
                 os.symlink(target, d)
-            elif os.path.isdir(link_target):
+            elif os.path.isdir(resolve_link_target_relative_to_the_link(s)):
                 mkdirp(d)
             else:
-                shutil.copyfile(s, d)
+                _copyfile(s, d)
+        elif stat.S_ISDIR(mode):
+            mkdirp(d)
         else:
-            if os.path.isdir(s):
-                mkdirp(d)
-            else:
-                shutil.copyfile(s, d)
+            _copyfile(s, d)
 
         if _permissions:
+            if stat.S_ISLNK(mode):
+                # Preserved links are left alone, and the mode of followed
+                # ones is the one of their target
+                if symlinks:
+                    return
+                s_stat = os.stat(s)
             set_install_permissions(d)
-            copy_mode(s, d)
+            copy_mode(s, d, s_stat)
+
+    # Directories are created right away in pre-order, so that they all
+    # exist before anything is copied into them. Files and links are
+    # copied afterwards, using a pool of threads for large trees since
+    # copying is I/O bound.
+    entries = []
+    for s, d in traverse_tree(src, dest, order='pre',
+                              follow_symlinks=not symlinks,
+                              ignore=ignore,
+                              follow_nonexisting=True):
+        # A single lstat tells us whether this is a link, a directory
+        # or a file: don't issue more syscalls than needed
+        s_stat = os.lstat(s)
+        if stat.S_ISDIR(s_stat.st_mode):
+            copy_entry(s, d, s_stat)
+        else:
+            entries.append((s, d, s_stat))
+
+    if parallel and len(entries) >= _copy_tree_parallel_threshold:
+        pool = ThreadPool(_copy_tree_jobs)
+        try:
+            pool.map(lambda args: copy_entry(*args), entries)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in entries:
+            copy_entry(*args)
 
 
 def install_tree(src, dest, symlinks=True, ignore=None):
@@ -416,24 +623,30 @@ def get_filetype(path_name):
 def mkdirp(*paths):
     """Creates a directory, as well as parent directories if needed."""
     for path in paths:
-        if not os.path.exists(path):
+        # A single stat in the common case where the directory exists
+        try:
+            mode = os.stat(path).st_mode
+        except OSError:
             try:
                 os.makedirs(path)
             except OSError as e:
                 if e.errno != errno.EEXIST or not os.path.isdir(path):
                     raise e
-        elif not os.path.isdir(path):
-            raise OSError(errno.EEXIST, "File already exists", path)
+        else:
+            if not stat.S_ISDIR(mode):
+                raise OSError(errno.EEXIST, "File already exists", path)
 
 
 def force_remove(*paths):
-    """Remove files without printing errors.  Like ``rm -f``, does NOT
-       remove directories."""
+    """Remove files without printing errors.  Like ``rm -f``, ignores files
+       that do not exist and does NOT remove directories."""
     for path in paths:
         try:
             os.remove(path)
-        except OSError:
-            pass
+        except OSError as e:
+            missing = e.errno in (errno.ENOENT, errno.ENOTDIR)
+            if not missing and not os.path.isdir(path):
+                raise
 
 
 @contextmanager
@@ -501,6 +714,10 @@ def replace_directory_transaction(directory_name, tmp_root=None):
         tty.debug('TEMPORARY DIRECTORY DELETED [{0}]'.format(tmp_dir))
 
 
+#: Size of the blocks read when hashing files in ``hash_directory``
+_hash_chunk_size = 1024 * 1024
+
+
 def hash_directory(directory):
     """Hashes recursively the content of a directory.
 
@@ -512,19 +729,29 @@ def hash_directory(directory):
     """
     assert os.path.isdir(directory), '"directory" must be a directory!'
 
-    md5_hash = hashlib.md5()
+    # The hash is only used as a fingerprint of the content, so prefer the
+    # faster BLAKE2b where available (Python >= 3.6)
+    if hasattr(hashlib, 'blake2b'):
+        content_hash = hashlib.blake2b(digest_size=16)
+    else:
+        content_hash = hashlib.md5()
 
     # Adapted from https://stackoverflow.com/a/3431835/771663
     for root, dirs, files in os.walk(directory):
         for name in sorted(files):
             filename = os.path.join(root, name)
-            # TODO: if caching big files becomes an issue, convert this to
-            # TODO: read in chunks. Currently it's used only for testing
-            # TODO: purposes.
+            # Mix in the relative path, so that renaming a file changes
+            # the hash even if the content stays the same
+            relative_name = os.path.relpath(filename, directory)
+            if isinstance(relative_name, six.text_type):
+                relative_name = relative_name.encode('utf-8')
+            content_hash.update(relative_name + b'\0')
+            # Read in chunks to bound memory usage on big files
             with open(filename, 'rb') as f:
-                md5_hash.update(f.read())
+                for chunk in iter(lambda: f.read(_hash_chunk_size), b''):
+                    content_hash.update(chunk)
 
-    return md5_hash.hexdigest()
+    return content_hash.hexdigest()
 
 
 def touch(path):
@@ -555,10 +782,7 @@ def force_symlink(src, dest):
 
 
 def join_path(prefix, *args):
-    path = str(prefix)
-    for elt in args:
-        path = os.path.join(path, str(elt))
-    return path
+    return os.path.join(str(prefix), *[str(elt) for elt in args])
 
 
 def ancestor(dir, n=1):
@@ -621,43 +845,60 @@ def traverse_tree(source_root, dest_root, rel_path='', **kwargs):
     if ignore(rel_path):
         return
 
-    source_path = os.path.join(source_root, rel_path)
-    dest_path = os.path.join(dest_root, rel_path)
-
     # preorder yields directories before children
     if order == 'pre':
-        yield (source_path, dest_path)
-
-    for f in os.listdir(source_path):
-        source_child = os.path.join(source_path, f)
-        dest_child = os.path.join(dest_path, f)
-        rel_child = os.path.join(rel_path, f)
-
-        # Treat as a directory
-        # TODO: for symlinks, os.path.isdir looks for the link target. If the
-        # target is relative to the link, then that may not resolve properly
-        # relative to our cwd - see resolve_link_target_relative_to_the_link
-        if os.path.isdir(source_child) and (
-                follow_links or not os.path.islink(source_child)):
-
-            # When follow_nonexisting isn't set, don't descend into dirs
-            # in source that do not exist in dest
-            if follow_nonexisting or os.path.exists(dest_child):
-                tuples = traverse_tree(
-                    source_root, dest_root, rel_child, **kwargs)
-                for t in tuples:
-                    yield t
-
-        # Treat as a file.
-        elif not ignore(os.path.join(rel_path, f)):
-            yield (source_child, dest_child)
-
-    if order == 'post':
-        yield (source_path, dest_path)
-
-
-def set_executable(path):
-    mode = os.stat(path).st_mode
+        yield (os.path.join(source_root, rel_path),
+               os.path.join(dest_root, rel_path))
+
+    # Walk the tree with an explicit stack of the directories being
+    # listed, rather than with nested generators
+    stack = [(rel_path, iter(os.listdir(os.path.join(source_root,
+                                                     rel_path))))]
+    while stack:
+        rel_dir, children = stack[-1]
+
+        for f in children:
+            rel_child = os.path.join(rel_dir, f)
+            source_child = os.path.join(source_root, rel_child)
+            dest_child = os.path.join(dest_root, rel_child)
+
+            # Treat as a directory. Use a single lstat for the common case,
+            # and stat the target only for links we are asked to follow.
+            # TODO: for symlinks, os.path.isdir looks for the link target.
+            # If the target is relative to the link, then that may not
+            # resolve properly relative to our cwd - see
+            # resolve_link_target_relative_to_the_link
+            mode = os.lstat(source_child).st_mode
+            if stat.S_ISDIR(mode) or (
+                    follow_links and stat.S_ISLNK(mode) and
+                    os.path.isdir(source_child)):
+
+                # When follow_nonexisting isn't set, don't descend into dirs
+                # in source that do not exist in dest. Don't descend into
+                # ignored directories either.
+                if ((follow_nonexisting or os.path.exists(dest_child)) and
+                        not ignore(rel_child)):
+                    if order == 'pre':
+                        yield (source_child, dest_child)
+
+                    # Descend, and resume with the siblings afterwards
+                    stack.append((rel_child, iter(os.listdir(source_child))))
+                    break
+
+            # Treat as a file.
+            elif not ignore(rel_child):
+                yield (source_child, dest_child)
+
+        else:
+            # All the children have been traversed
+            stack.pop()
+            if order == 'post':
+                yield (os.path.join(source_root, rel_dir),
+                       os.path.join(dest_root, rel_dir))
+
+
+def set_executable(path, path_stat=None):
+    mode = (path_stat or os.stat(path)).st_mode
     if mode & stat.S_IRUSR:
         mode |= stat.S_IXUSR
     if mode & stat.S_IRGRP:
@@ -717,28 +958,34 @@ def fix_darwin_install_name(path):
        libs. The function assumes that all libraries are in one folder and
        currently won't follow subfolders.
 
+    Both are done with a single call to ``install_name_tool`` per library.
+
     Parameters:
         path (str): directory in which .dylib files are located
     """
     libs = glob.glob(join_path(path, "*.dylib"))
+
+    # We really want to check for either
+    #     dep == os.path.basename(loc)   or
+    #     dep == join_path(builddir, os.path.basename(loc)),
+    # but we don't know builddir (nor how symbolic links look
+    # in builddir). We thus only compare the basenames.
+    libs_by_basename = dict((os.path.basename(loc), loc) for loc in libs)
+
+    install_name_tool = Executable('install_name_tool')
+    otool = Executable('otool')
     for lib in libs:
-        # fix install name first:
-        install_name_tool = Executable('install_name_tool')
-        install_name_tool('-id', lib, lib)
-        otool = Executable('otool')
         long_deps = otool('-L', lib, output=str).split('\n')
         deps = [dep.partition(' ')[0][1::] for dep in long_deps[2:-1]]
-        # fix all dependencies:
+
+        # Fix the install name and all dependencies with a single call
+        args = ['-id', lib]
         for dep in deps:
-            for loc in libs:
-                # We really want to check for either
-                #     dep == os.path.basename(loc)   or
-                #     dep == join_path(builddir, os.path.basename(loc)),
-                # but we don't know builddir (nor how symbolic links look
-                # in builddir). We thus only compare the basenames.
-                if os.path.basename(dep) == os.path.basename(loc):
-                    install_name_tool('-change', dep, loc, lib)
-                    break
+            loc = libs_by_basename.get(os.path.basename(dep))
+            if loc is not None:
+                args.extend(['-change', dep, loc])
+        args.append(lib)
+        install_name_tool(*args)
 
 
 def find(root, files, recursive=True):
@@ -794,6 +1041,13 @@ def find(root, files, recursive=True):
 
 
 def _find_recursive(root, search_files):
+    # Make the path absolute to have the walk also return an absolute path
+    root = os.path.abspath(root)
+    return _find_in_walk(_walk_parallel(root), search_files)
+
+
+def _find_in_walk(walk, search_files):
+    """Search for ``search_files`` in the result of ``_walk_parallel``."""
 
     # The variable here is **on purpose** a defaultdict. The idea is that
     # we want to poke the filesystem as little as possible, but still maintain
@@ -801,14 +1055,17 @@ def _find_recursive(root, search_files):
     # found in a key, and reconstructing the stable order later.
     found_files = collections.defaultdict(list)
 
-    # Make the path absolute to have os.walk also return an absolute path
-    root = os.path.abspath(root)
+    any_pattern = _compile_any_pattern(tuple(search_files))
 
-    for path, _, list_files in os.walk(root):
+    for path, dirs, files in walk:
+        # The walk already listed the directory, so match the names it
+        # returned instead of listing it again for each pattern. Most
+        # names match none of the patterns, so drop them with a single
+        # regex before checking the patterns one by one.
+        names = list(filter(any_pattern.match, dirs + files))
         for search_file in search_files:
-            matches = glob.glob(os.path.join(path, search_file))
-            matches = [os.path.join(path, x) for x in matches]
-            found_files[search_file].extend(matches)
+            found_files[search_file].extend(
+                _glob_names(path, names, search_file))
 
     answer = []
     for search_file in search_files:
@@ -817,6 +1074,169 @@ def _find_recursive(root, search_files):
     return answer
 
 
+#: Number of threads used to walk directory trees in ``find``. Listing
+#: directories in parallel doesn't scale on APFS, so use fewer on macOS.
+_walk_jobs = 4 if sys.platform == 'darwin' else _copy_tree_jobs
+
+#: Number of directories waiting to be listed before ``find`` starts to
+#: list them with threads. Small trees are walked faster without threads.
+_walk_parallel_threshold = 16
+
+
+def _walk_parallel(root, jobs=None):
+    """Same as ``os.walk(root)``, but lists directories with many threads.
+
+    Walking a tree is bound by the latency of listing each directory,
+    especially on network filesystems, so list many of them at once.
+    Small trees are listed in the calling thread, and threads are only
+    added while there is a backlog of directories to list.
+
+    Parameters:
+        root (str): The root directory of the walk
+        jobs (int, optional): Maximum number of threads listing directories
+
+    Returns:
+        list of tuples: ``(path, dirs, files)`` for each directory, in the
+            same order as ``os.walk`` would yield them
+    """
+    jobs = jobs or _walk_jobs
+
+    # Each directory is keyed by the indices of the subdirectories that
+    # lead to it, so that sorting by key gives back a top-down walk
+    walked = []
+
+    def list_directory(key, path, add):
+        try:
+            dirs, files, links = _list_directory(path)
+        except OSError:
+            return
+        walked.append((key, path, dirs, files))
+
+        # Like os.walk, don't descend into links to directories
+        for i, name in enumerate(dirs):
+            if name not in links:
+                add((key + (i,), os.path.join(path, name)))
+
+    # Starting threads costs more than it saves until there are enough
+    # directories to list
+    waiting = [((), root)]
+    while waiting and len(waiting) < _walk_parallel_threshold:
+        key, path = waiting.pop()
+        list_directory(key, path, waiting.append)
+
+    if waiting:
+        _list_directories_parallel(waiting, list_directory, jobs)
+
+    walked.sort(key=lambda x: x[0])
+    return [(path, dirs, files) for _, path, dirs, files in walked]
+
+
+def _list_directories_parallel(waiting, list_directory, jobs):
+    """Calls ``list_directory(key, path, add)`` on each ``(key, path)``
+    in ``waiting``, and on each item it passes to ``add``, with up to
+    ``jobs`` threads. Re-raises the first error raised in a thread.
+    """
+    pending = six.moves.queue.Queue()
+    errors = []
+    threads = []
+    threads_lock = threading.Lock()
+
+    def start_thread():
+        t = threading.Thread(target=list_directories)
+        t.daemon = True
+        t.start()
+        threads.append(t)
+
+    def add(item):
+        pending.put(item)
+
+        # Add threads only while directories are waiting to be listed
+        with threads_lock:
+            if len(threads) < jobs and pending.qsize() > len(threads):
+                start_thread()
+
+    def list_directories():
+        while True:
+            item = pending.get()
+            try:
+                if item is None:
+                    return
+                # After an error, keep draining the queue so that the
+                # caller isn't left waiting for directories forever
+                if not errors:
+                    list_directory(item[0], item[1], add)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                pending.task_done()
+
+    for item in waiting:
+        pending.put(item)
+    with threads_lock:
+        for _ in range(min(jobs, len(waiting))):
+            start_thread()
+
+    pending.join()
+    for t in threads:
+        pending.put(None)
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+
+
+#: ``os.scandir`` on Python 3.5 and later, otherwise None
+_scandir = getattr(os, 'scandir', None)
+
+
+def _list_directory(path):
+    """Lists a directory, splitting its entries like ``os.walk`` does.
+
+    Uses ``os.scandir`` where available, which gets the type of most
+    entries from the directory listing itself. Otherwise stats each entry
+    only once, instead of checking separately if it is a directory and
+    if it is a link.
+
+    Returns:
+        tuple: ``(dirs, files, links)`` where ``dirs`` includes links to
+            directories and ``links`` is the set of them
+    """
+    dirs, files, links = [], [], set()
+
+    if _scandir:
+        for entry in _scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry.name)
+                continue
+            dirs.append(entry.name)
+            if entry.is_symlink():
+                links.add(entry.name)
+        return dirs, files, links
+
+    for name in os.listdir(path):
+        entry = os.path.join(path, name)
+        is_link = False
+        try:
+            mode = os.lstat(entry).st_mode
+            if stat.S_ISLNK(mode):
+                is_link = True
+                mode = os.stat(entry).st_mode
+        except OSError:
+            mode = 0
+        if not stat.S_ISDIR(mode):
+            files.append(name)
+            continue
+        dirs.append(name)
+        if is_link:
+            links.add(name)
+    return dirs, files, links
+
+
 def _find_non_recursive(root, search_files):
     # The variable here is **on purpose** a defaultdict as os.list_dir
     # can return files in any order (does not preserve stability)
@@ -825,10 +1245,22 @@ def _find_non_recursive(root, search_files):
     # Make the path absolute to have absolute path returned
     root = os.path.abspath(root)
 
+    # Literal names (e.g. 'libfoo.so') can be checked with a few stat
+    # calls, without listing a possibly large directory
+    if not any(glob.has_magic(x) for x in search_files):
+        candidates = [os.path.join(root, x) for x in search_files]
+        return [x for x in candidates if os.path.lexists(x)]
+
+    try:
+        names = os.listdir(root)
+    except OSError:
+        # Like glob, don't complain if root is not a directory
+        names = []
+
+    any_pattern = _compile_any_pattern(tuple(search_files))
+    names = list(filter(any_pattern.match, names))
     for search_file in search_files:
-        matches = glob.glob(os.path.join(root, search_file))
-        matches = [os.path.join(root, x) for x in matches]
-        found_files[search_file].extend(matches)
+        found_files[search_file].extend(_glob_names(root, names, search_file))
 
     answer = []
     for search_file in search_files:
@@ -837,9 +1269,75 @@ def _find_non_recursive(root, search_files):
     return answer
 
 
+@memoized
+def _compile_any_pattern(patterns):
+    """Returns a compiled regex matching the names that match any of
+    the glob ``patterns``.
+
+    Patterns spanning subdirectories are globbed separately and are left
+    out, so the regex never matches if there are no other patterns. The
+    regex is memoized, as the same patterns are searched in many roots.
+
+    Parameters:
+        patterns (tuple of str): The glob patterns
+    """
+    regexes = ['(?:{0})'.format(fnmatch.translate(x))
+               for x in patterns if os.sep not in x]
+    return re.compile('|'.join(regexes) or '(?!)')
+
+
+def _glob_names(path, names, pattern):
+    """Returns the entries of ``path`` that match ``pattern``.
+
+    Same as ``glob.glob(os.path.join(path, pattern))``, but uses the
+    list of ``names`` in ``path`` instead of listing it again.
+    """
+    # Patterns spanning subdirectories need to be globbed
+    if os.sep in pattern:
+        return glob.glob(os.path.join(path, pattern))
+
+    # Literal names (e.g. 'libfoo.so') don't need any matching
+    if not glob.has_magic(pattern):
+        return [os.path.join(path, pattern)] if pattern in names else []
+
+    # Like glob, match hidden files only with patterns starting with '.'
+    if not pattern.startswith('.'):
+        names = [x for x in names if not x.startswith('.')]
+
+    # Same as fnmatch.filter, but the loop over names runs in C
+    match = _compile_any_pattern((pattern,)).match
+    return [os.path.join(path, x) for x in filter(match, names)]
+
+
 # Utilities for libraries and headers
 
 
+def _as_sequence(items, function):
+    """Returns ``items`` as a sequence of strings, for the search functions.
+
+    Parameters:
+        items (str or collections.Sequence): What to search for
+        function (function): The caller, to report errors
+
+    Raises:
+        TypeError: if ``items`` is neither a string nor a sequence
+    """
+    # Check the common types by identity first, avoiding the slower checks
+    # that are still needed for unicode on Python 2 and other sequences
+    if type(items) is str:
+        return [items]
+    if type(items) in (list, tuple):
+        return items
+    if isinstance(items, six.string_types):
+        return [items]
+    if isinstance(items, collections.Sequence):
+        return items
+
+    message = '{0} expects a string or sequence of strings as the '
+    message += 'first argument [got {1} instead]'
+    raise TypeError(message.format(function.__name__, type(items)))
+
+
 class FileList(collections.Sequence):
     """Sequence of absolute paths to files.
 
@@ -850,7 +1348,18 @@ class FileList(collections.Sequence):
         if isinstance(files, six.string_types):
             files = [files]
 
-        self.files = list(dedupe(files))
+        # De-duplicate while filling the set used for membership tests
+        self.files, self._files_set = [], set()
+        append, add = self.files.append, self._files_set.add
+        for x in files:
+            if x not in self._files_set:
+                add(x)
+                append(x)
+
+        # Lazily computed, as files are not modified after construction
+        self._directories = None
+        self._basenames = None
+        self._names = None
 
     @property
     def directories(self):
@@ -866,9 +1375,9 @@ class FileList(collections.Sequence):
         Returns:
             list of strings: A list of directories
         """
-        return list(dedupe(
-            os.path.dirname(x) for x in self.files if os.path.dirname(x)
-        ))
+        if self._directories is None:
+            self._split_files()
+        return list(self._directories)
 
     @property
     def basenames(self):
@@ -884,7 +1393,17 @@ class FileList(collections.Sequence):
         Returns:
             list of strings: A list of base-names
         """
-        return list(dedupe(os.path.basename(x) for x in self.files))
+        if self._basenames is None:
+            self._split_files()
+        return list(self._basenames)
+
+    def _split_files(self):
+        """Splits each file only once to get both the directories and
+        the base-names in the list.
+        """
+        split = [os.path.split(x) for x in self.files]
+        self._directories = list(dedupe(d for d, _ in split if d))
+        self._basenames = list(dedupe(b for _, b in split))
 
     def __getitem__(self, item):
         cls = type(self)
@@ -892,8 +1411,12 @@ class FileList(collections.Sequence):
             return self.files[item]
         return cls(self.files[item])
 
+    def __contains__(self, item):
+        return item in self._files_set
+
     def __add__(self, other):
-        return self.__class__(dedupe(self.files + list(other)))
+        # The constructor takes care of de-duplication
+        return self.__class__(self.files + list(other))
 
     def __radd__(self, other):
         return self.__add__(other)
@@ -914,6 +1437,43 @@ class FileList(collections.Sequence):
         return self.joined()
 
 
+#: Valid extensions of headers, in order of preference
+_header_extensions = ('.cuh', '.hpp', '.hh', '.h')
+
+
+def _prefixed_join(prefix, items):
+    """Joins ``items`` with spaces, each one preceded by ``prefix``.
+
+    >>> _prefixed_join('-I', ['/dir1', '/dir2'])
+    '-I/dir1 -I/dir2'
+    """
+    if not items:
+        return ''
+    return prefix + (' ' + prefix).join(items)
+
+
+def _strip_extensions(names, extensions):
+    """Stable de-duplication of ``names`` without their extension.
+
+    Each name is cut at the last occurrence of the first of the
+    ``extensions`` it contains, so that versioned libraries like
+    ``libfoo.so.1`` lose their version too. Names without any valid
+    extension are kept as they are.
+    """
+    stripped, seen = [], set()
+    append, add = stripped.append, seen.add
+    for name in names:
+        for ext in extensions:
+            head, found, _ = name.rpartition(ext)
+            if found:
+                name = head
+                break
+        if name not in seen:
+            add(name)
+            append(name)
+    return stripped
+
+
 class HeaderList(FileList):
     """Sequence of absolute paths to headers.
 
@@ -946,22 +1506,10 @@ class HeaderList(FileList):
         Returns:
             list of strings: A list of files without extensions
         """
-        names = []
-
-        for x in self.basenames:
-            name = x
-
-            # Valid extensions include: ['.cuh', '.hpp', '.hh', '.h']
-            for ext in ['.cuh', '.hpp', '.hh', '.h']:
-                i = name.rfind(ext)
-                if i != -1:
-                    names.append(name[:i])
-                    break
-            else:
-                # No valid extension, should we still include it?
-                names.append(name)
-
-        return list(dedupe(names))
+        if self._names is None:
+            self._names = _strip_extensions(
+                self.basenames, _header_extensions)
+        return list(self._names)
 
     @property
     def include_flags(self):
@@ -974,7 +1522,7 @@ class HeaderList(FileList):
         Returns:
             str: A joined list of include flags
         """
-        return ' '.join(['-I' + x for x in self.directories])
+        return _prefixed_join('-I', self.directories)
 
     @property
     def macro_definitions(self):
@@ -1043,13 +1591,7 @@ def find_headers(headers, root, recursive=False):
     Returns:
         HeaderList: The headers that have been found
     """
-    if isinstance(headers, six.string_types):
-        headers = [headers]
-    elif not isinstance(headers, collections.Sequence):
-        message = '{0} expects a string or sequence of strings as the '
-        message += 'first argument [got {1} instead]'
-        message = message.format(find_headers.__name__, type(headers))
-        raise TypeError(message)
+    headers = _as_sequence(headers, find_headers)
 
     # Construct the right suffix for the headers
     suffix = 'h'
@@ -1060,6 +1602,10 @@ def find_headers(headers, root, recursive=False):
     return HeaderList(find(root, headers, recursive))
 
 
+#: Valid extensions of libraries, in order of preference
+_library_extensions = ('.dylib', '.so', '.a')
+
+
 class LibraryList(FileList):
     """Sequence of absolute paths to libraries
 
@@ -1087,24 +1633,11 @@ class LibraryList(FileList):
         Returns:
             list of strings: A list of library names
         """
-        names = []
-
-        for x in self.basenames:
-            name = x
-            if x.startswith('lib'):
-                name = x[3:]
-
-            # Valid extensions include: ['.dylib', '.so', '.a']
-            for ext in ['.dylib', '.so', '.a']:
-                i = name.rfind(ext)
-                if i != -1:
-                    names.append(name[:i])
-                    break
-            else:
-                # No valid extension, should we still include it?
-                names.append(name)
-
-        return list(dedupe(names))
+        if self._names is None:
+            self._names = _strip_extensions(
+                (x[3:] if x.startswith('lib') else x for x in self.basenames),
+                _library_extensions)
+        return list(self._names)
 
     @property
     def search_flags(self):
@@ -1117,7 +1650,7 @@ class LibraryList(FileList):
         Returns:
             str: A joined list of search flags
         """
-        return ' '.join(['-L' + x for x in self.directories])
+        return _prefixed_join('-L', self.directories)
 
     @property
     def link_flags(self):
@@ -1130,7 +1663,7 @@ class LibraryList(FileList):
         Returns:
             str: A joined list of link flags
         """
-        return ' '.join(['-l' + name for name in self.names])
+        return _prefixed_join('-l', self.names)
 
     @property
     def ld_flags(self):
@@ -1158,6 +1691,9 @@ def find_system_libraries(libraries, shared=True):
     5. ``/usr/local/lib64``
     6. ``/usr/local/lib``
 
+    Results are cached in memory until any of the directories searched
+    is modified.
+
     Accepts any glob characters accepted by fnmatch:
 
     =======  ====================================
@@ -1177,33 +1713,113 @@ def find_system_libraries(libraries, shared=True):
     Returns:
         LibraryList: The libraries that have been found
     """
-    if isinstance(libraries, six.string_types):
-        libraries = [libraries]
-    elif not isinstance(libraries, collections.Sequence):
-        message = '{0} expects a string or sequence of strings as the '
-        message += 'first argument [got {1} instead]'
-        message = message.format(find_system_libraries.__name__,
-                                 type(libraries))
-        raise TypeError(message)
+    libraries = _as_sequence(libraries, find_system_libraries)
+    key = (tuple(libraries), shared)
+
+    # System locations seldom change, so reuse the results of previous
+    # searches unless any of the directories they walked has been modified
+    # since then. Adding or removing a file or directory anywhere in the
+    # walked trees changes the modification time of its parent.
+    cached = _system_libraries_cache.get(key)
+    if cached is not None:
+        stamps, found = cached
+        if all(_modification_time(path) == t for path, t in stamps):
+            return LibraryList(found)
+
+    stamps, found = _search_system_libraries(libraries, shared)
+    if stamps is not None:
+        _system_libraries_cache[key] = (stamps, found)
+    return LibraryList(found)
+
+
+_system_library_locations = (
+    '/lib64',
+    '/lib',
+    '/usr/lib64',
+    '/usr/lib',
+    '/usr/local/lib64',
+    '/usr/local/lib',
+)
+
+#: Results of ``find_system_libraries``, keyed by the libraries and the
+#: type of library searched for
+_system_libraries_cache = {}
+
+#: Directories modified less than this many seconds before a search of
+#: system libraries may have been modified after they were listed, so
+#: their results are not cached. Some filesystems only store times to
+#: the second or two.
+_system_libraries_settle_time = 2
+
+
+def _modification_time(path):
+    """Returns the modification time of ``path`` in nanoseconds, or None
+    if it doesn't exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    # st_mtime_ns is only available on Python 3.3 and later
+    if hasattr(st, 'st_mtime_ns'):
+        return st.st_mtime_ns
+    return int(st.st_mtime * 1e9)
+
+
+def _search_system_libraries(libraries, shared):
+    """Searches the system library locations for ``libraries``.
+
+    Returns:
+        tuple: ``(stamps, found)``, where ``found`` is a tuple of the
+            libraries that have been found, and ``stamps`` is a tuple of
+            ``(path, modification time)`` for the locations and every
+            directory that was walked, or None if the result shouldn't
+            be cached
+    """
+    search_locations = _system_library_locations
+    started = int((time.time() - _system_libraries_settle_time) * 1e9)
+
+    # Also stamp missing locations, so that creating one invalidates
+    stamps = [(root, _modification_time(root)) for root in search_locations]
+
+    # Each walk is bound by the latency of the filesystem, so walk all the
+    # locations at once, and only once for all the libraries
+    pool = ThreadPool(len(search_locations))
+    try:
+        walks = pool.map(
+            lambda root: _walk_parallel(os.path.abspath(root)),
+            search_locations)
+    finally:
+        pool.close()
+        pool.join()
 
+    # The first location with results wins for each library
     libraries_found = []
-    search_locations = [
-        '/lib64',
-        '/lib',
-        '/usr/lib64',
-        '/usr/lib',
-        '/usr/local/lib64',
-        '/usr/local/lib',
-    ]
-
-    for library in libraries:
-        for root in search_locations:
-            result = find_libraries(library, root, shared, recursive=True)
+    for name in _library_file_names(libraries, shared):
+        for walk in walks:
+            result = _find_in_walk(walk, [name])
             if result:
                 libraries_found += result
                 break
 
-    return libraries_found
+    stamps.extend((path, _modification_time(path))
+                  for walk in walks for path, _, _ in walk[1:])
+    if any(t is not None and t >= started for _, t in stamps):
+        stamps = None
+    else:
+        stamps = tuple(stamps)
+
+    # Return a tuple, so that callers can't modify the cached result
+    return stamps, tuple(libraries_found)
+
+
+def _library_file_names(libraries, shared):
+    """Returns the file names of ``libraries``, shared or static."""
+    if shared is True:
+        suffix = 'dylib' if sys.platform == 'darwin' else 'so'
+    else:
+        suffix = 'a'
+    return ['{0}.{1}'.format(lib, suffix) for lib in libraries]
 
 
 def find_libraries(libraries, root, shared=True, recursive=False):
@@ -1231,20 +1847,9 @@ def find_libraries(libraries, root, shared=True, recursive=False):
     Returns:
         LibraryList: The libraries that have been found
     """
-    if isinstance(libraries, six.string_types):
-        libraries = [libraries]
-    elif not isinstance(libraries, collections.Sequence):
-        message = '{0} expects a string or sequence of strings as the '
-        message += 'first argument [got {1} instead]'
-        message = message.format(find_libraries.__name__, type(libraries))
-        raise TypeError(message)
-
-    # Construct the right suffix for the library
-    if shared is True:
-        suffix = 'dylib' if sys.platform == 'darwin' else 'so'
-    else:
-        suffix = 'a'
+    libraries = _as_sequence(libraries, find_libraries)
+
     # List of libraries we are searching with suffixes
-    libraries = ['{0}.{1}'.format(lib, suffix) for lib in libraries]
+    libraries = _library_file_names(libraries, shared)
 
     return LibraryList(find(root, libraries, recursive))
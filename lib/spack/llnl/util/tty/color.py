@@ -107,6 +107,7 @@ colors = {'k': 30, 'K': 90,  # black
 
 # Regex to be used for color formatting
 color_re = r'@(?:@|\.|([*_])?([a-zA-Z])?(?:{((?:[^}]|}})*)})?)'
+_color_regex = re.compile(color_re)
 
 # Mapping from color arguments to values for tty.set_color
 color_when_values = {
@@ -215,7 +216,9 @@ def colorize(string, **kwargs):
             codes, for output to non-console devices.
     """
     color = _color_when_value(kwargs.get('color', get_color_when()))
-    string = re.sub(color_re, match_to_ansi(color), string)
+    # Most strings have no color expressions at all
+    if '@' in string:
+        string = _color_regex.sub(match_to_ansi(color), string)
     string = string.replace('}}', '}')
     return string
 
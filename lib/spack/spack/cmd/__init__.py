@@ -279,9 +279,9 @@ def display_specs(specs, args=None, **kwargs):
         specs = index[(architecture, compiler)]
         specs.sort()
 
-        abbreviated = [s.cformat(format_string) for s in specs]
         if mode == 'paths':
             # Print one spec per line along with prefix path
+            abbreviated = [s.cformat(format_string) for s in specs]
             width = max(len(s) for s in abbreviated)
             width += 2
             format = "    %%-%ds%%s" % width
@@ -28,7 +28,6 @@ import llnl.util.tty as tty
 import spack.cmd
 import spack.store
 from spack.filesystem_view import YamlFilesystemView
-from spack.graph import topological_sort
 
 description = "deactivate a package extension"
 section = "extensions"
@@ -87,15 +86,24 @@ def deactivate(parser, args):
             tty.msg("Deactivating %s and all dependencies." %
                     pkg.spec.short_spec)
 
-            topo_order = topological_sort(spec)
-            index = spec.index()
+            # Read the activated extensions once, instead of asking each
+            # package if it is activated. Without --force, these are the
+            # only extensions of the extendee that need to be deactivated.
+            extendee_spec = pkg.extendee_spec
+            activated = view.extensions_layout.extension_map(extendee_spec)
 
-            for name in topo_order:
-                espec = index[name]
-                epkg = espec.package
-                if epkg.extends(pkg.extendee_spec):
-                    if epkg.is_activated(view) or args.force:
-                        epkg.do_deactivate(view, force=args.force)
+            def needs_deactivation(s):
+                if args.force:
+                    return s.package.extends(extendee_spec)
+                return activated.get(s.name) == s
+
+            # Reversing a post-order traversal puts each spec before its
+            # dependencies, so that dependents are deactivated first
+            extensions = [s.package for s in spec.traverse(order='post')
+                          if needs_deactivation(s)]
+
+            for epkg in reversed(extensions):
+                epkg.do_deactivate(view, force=args.force)
 
         else:
             tty.die(
@@ -32,6 +32,7 @@ import spack.repo
 import spack.store
 
 from llnl.util import tty
+from llnl.util.lang import dedupe
 
 description = "remove installed packages"
 section = "build"
@@ -89,11 +90,28 @@ def find_matching_specs(specs, allow_multiple_matches=False, force=False):
     Return:
         list of specs
     """
+    # Read the installed specs once, instead of locking and reading the
+    # database again for each spec given via command line
+    installed = spack.store.db.query()
+
+    # Without any spec to match, i.e. for `spack uninstall --all`, every
+    # installed spec matches and there is nothing to check
+    if allow_multiple_matches and specs and all(x is any for x in specs):
+        return installed
+
     # List of specs that match expressions given via command line
     specs_from_cli = []
     has_errors = False
+
     for spec in specs:
-        matching = spack.store.db.query(spec)
+        if spec is any:
+            matching = installed
+        elif spec.concrete:
+            # Concrete specs are looked up by hash
+            matching = spack.store.db.query(spec)
+        else:
+            matching = [x for x in installed if x.satisfies(spec)]
+
         # For each spec provided, make sure it refers to only one package.
         # Fail and ask user to be unambiguous if it doesn't
         if not allow_multiple_matches and len(matching) > 1:
@@ -126,17 +144,56 @@ def installed_dependents(specs):
     Returns:
         dictionary of installed dependents
     """
+    # Compare specs by their DAG hash, which is computed once and cached,
+    # rather than by hashing and comparing the whole spec
     dependents = {}
+    hashes = set(x.dag_hash() for x in specs)
+    parents = _installed_parents(specs)
     for item in specs:
-        installed = spack.store.db.installed_relatives(
-            item, 'parents', True)
-        lst = [x for x in installed if x not in specs]
+        lst = [x for h, x in parents[item.dag_hash()].items()
+               if h not in hashes]
         if lst:
-            lst = list(set(lst))
             dependents[item] = lst
     return dependents
 
 
+def _installed_parents(specs):
+    """Returns a dictionary that maps the DAG hash of each spec in a list
+    to its installed dependents, counted transitively. The dependents of
+    each spec are given as a dictionary keyed by their DAG hash.
+
+    This gives the same result as calling ``installed_relatives`` on each
+    spec, but the DAG above the specs is walked only once for all of them.
+
+    Args:
+        specs: list of installed specs
+
+    Returns:
+        dictionary of transitive installed dependents
+    """
+    # Transitive dependents of each spec visited, installed or not
+    visited = {}
+
+    def all_parents(spec):
+        key = spec.dag_hash()
+        if key not in visited:
+            result = {}
+            for parent in spec.dependents():
+                result[parent.dag_hash()] = parent
+                result.update(all_parents(parent))
+            visited[key] = result
+        return visited[key]
+
+    with spack.store.db.read_transaction():
+        installed = set(x.dag_hash() for x in spack.store.db.query())
+        parents = {}
+        for item in specs:
+            parents[item.dag_hash()] = dict(
+                (h, x) for h, x in all_parents(item).items()
+                if h in installed)
+    return parents
+
+
 def do_uninstall(specs, force):
     """
     Uninstalls all the specs in a list.
@@ -156,13 +213,11 @@ def do_uninstall(specs, force):
             spack.package.Package.uninstall_by_spec(item, force=True)
 
     # Sort packages to be uninstalled by the number of installed dependents
-    # This ensures we do things in the right order
-    def num_installed_deps(pkg):
-        dependents = spack.store.db.installed_relatives(
-            pkg.spec, 'parents', True)
-        return len(dependents)
-
-    packages.sort(key=num_installed_deps)
+    # This ensures we do things in the right order: dependents are counted
+    # transitively, so each package has strictly fewer of them than any of
+    # its dependencies, and sorting gives a topological order of the DAG.
+    parents = _installed_parents([pkg.spec for pkg in packages])
+    packages.sort(key=lambda pkg: len(parents[pkg.spec.dag_hash()]))
     for item in packages:
         item.do_uninstall(force=force)
 
@@ -172,12 +227,18 @@ def get_uninstall_list(args):
     if args.packages:
         specs = spack.cmd.parse_specs(args.packages)
 
-    # Gets the list of installed specs that match the ones give via cli
-    # takes care of '-a' is given in the cli
-    uninstall_list = find_matching_specs(specs, args.all, args.force)
+    # Find both the specs and their dependents in the same transaction, so
+    # that the database is read only once
+    with spack.store.db.read_transaction():
+        # Gets the list of installed specs that match the ones give via cli
+        # takes care of '-a' is given in the cli
+        uninstall_list = find_matching_specs(specs, args.all, args.force)
 
-    # Takes care of '-d'
-    dependent_list = installed_dependents(uninstall_list)
+        # Takes care of '-d'. Dependents don't matter when forcing the
+        # uninstall without them, so don't look for them at all.
+        dependent_list = {}
+        if args.dependents or not args.force:
+            dependent_list = installed_dependents(uninstall_list)
 
     # Process dependent_list and update uninstall_list
     has_error = False
@@ -192,7 +253,7 @@ def get_uninstall_list(args):
     elif args.dependents:
         for key, lst in dependent_list.items():
             uninstall_list.extend(lst)
-        uninstall_list = list(set(uninstall_list))
+        uninstall_list = list(dedupe(uninstall_list))
     if has_error:
         tty.die('Use `spack uninstall --dependents` '
                 'to uninstall these dependencies as well.')
@@ -23,6 +23,8 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 ##############################################################################
+import re
+
 from spack.compiler import \
     Compiler, get_compiler_version, UnsupportedCompilerFlag
 from spack.version import ver
@@ -47,6 +49,9 @@ class XlR(Compiler):
                   'f77': 'xl_r/xlf_r',
                   'fc': 'xl_r/xlf90_r'}
 
+    # Matches the version in the output of '-qversion'
+    version_regex = re.compile(r'([0-9]?[0-9]\.[0-9])')
+
     @property
     def openmp_flag(self):
         return "-qsmp=omp"
@@ -97,8 +102,7 @@ class XlR(Compiler):
               Version: 09.00.0000.0017
         """
 
-        return get_compiler_version(
-            comp, '-qversion', r'([0-9]?[0-9]\.[0-9])')
+        return get_compiler_version(comp, '-qversion', cls.version_regex)
 
     @classmethod
     def fc_version(cls, fc):
@@ -114,17 +118,25 @@ class XlR(Compiler):
            available. BG/P and BG/L can such a compiler mix and possibly
            older version of AIX and linux on power.
         """
-        fver = get_compiler_version(fc, '-qversion', r'([0-9]?[0-9]\.[0-9])')
-        if fver >= 16:
+        fver = get_compiler_version(fc, '-qversion', cls.version_regex)
+        try:
+            major, minor = (int(x) for x in fver.split('.'))
+        except ValueError:
+            # Unknown version
+            return fver
+
+        if major >= 16:
             """Starting with version 16.1, the XL C and Fortran compilers
                have the same version.  So no need to downgrade the Fortran
                compiler version to match that of the C compiler version.
             """
-            return str(fver)
-        cver = float(fver) - 2
-        if cver < 10:
-            cver = cver - 0.1
-        return str(cver)
+            return fver
+
+        # Count in tenths of a version, to avoid floating point rounding
+        tenths = major * 10 + minor - 20
+        if tenths < 100:
+            tenths -= 1
+        return '{0}.{1}'.format(*divmod(tenths, 10))
 
     @classmethod
     def f77_version(cls, f77):
@@ -39,12 +39,15 @@ provides a cache and a sanity checking mechanism for what is in the
 filesystem.
 
 """
+import collections
 import datetime
 import time
 import os
 import sys
 import socket
 import contextlib
+import weakref
+from multiprocessing.pool import ThreadPool
 from six import string_types
 from six import iteritems
 
@@ -78,12 +81,33 @@ _db_lock_timeout = 120
 # Types of dependencies tracked by the database
 _tracked_deps = ('link', 'run')
 
+# Number of threads used to stat install prefixes when reindexing
+_stat_jobs = 16
+
 
 def _now():
     """Returns the time since the epoch"""
     return time.time()
 
 
+def _prefix_ctimes(specs):
+    """Returns a dictionary mapping the prefixes of some specs to their
+    ctime. Prefixes are stat'ed in parallel, as each stat can take a while
+    on shared filesystems.
+    """
+    prefixes = [s.prefix for s in specs]
+    if len(prefixes) < 2:
+        return dict((p, os.stat(p).st_ctime) for p in prefixes)
+
+    pool = ThreadPool(min(_stat_jobs, len(prefixes)))
+    try:
+        return dict(zip(prefixes, pool.map(
+            lambda p: os.stat(p).st_ctime, prefixes)))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def _autospec(function):
     """Decorator that automatically converts the argument of a single-arg
        function to a Spec."""
@@ -121,6 +145,10 @@ class InstallRecord(object):
         installation_time (time, optional): time of the installation
     """
 
+    # There is one record per installed spec, so avoid a __dict__ for each
+    __slots__ = ('spec', 'path', 'installed', 'ref_count', 'explicit',
+                 'installation_time', '_spec_dict')
+
     def __init__(
             self,
             spec,
@@ -136,10 +164,19 @@ class InstallRecord(object):
         self.ref_count = ref_count
         self.explicit = explicit
         self.installation_time = installation_time or _now()
+        self._spec_dict = None
 
     def to_dict(self):
+        # The node dict of a concrete spec does not change, so compute it
+        # only once instead of every time the database is written.
+        spec_dict = self._spec_dict
+        if spec_dict is None:
+            spec_dict = self.spec.to_node_dict()
+            if self.spec.concrete:
+                self._spec_dict = spec_dict
+
         return {
-            'spec': self.spec.to_node_dict(),
+            'spec': spec_dict,
             'path': self.path,
             'installed': self.installed,
             'ref_count': self.ref_count,
@@ -149,15 +186,21 @@ class InstallRecord(object):
 
     @classmethod
     def from_dict(cls, spec, dictionary):
-        d = dict(dictionary.items())
-        d.pop('spec', None)
-        return InstallRecord(spec, **d)
+        return InstallRecord(
+            spec,
+            dictionary['path'],
+            dictionary['installed'],
+            ref_count=dictionary.get('ref_count', 0),
+            explicit=dictionary.get('explicit', False),
+            installation_time=dictionary.get('installation_time'))
 
 
 class Database(object):
 
     """Per-process lock objects for each install prefix."""
-    _prefix_locks = {}
+    # Locks are only kept while they are referenced, i.e. while they are
+    # held, so that this does not grow with every prefix ever locked.
+    _prefix_locks = weakref.WeakValueDictionary()
 
     def __init__(self, root, db_dir=None):
         """Create a Database for Spack installations under ``root``.
@@ -207,16 +250,21 @@ class Database(object):
             spack.config.get('config:db_lock_timeout') or _db_lock_timeout)
         self.package_lock_timeout = (
             spack.config.get('config:package_lock_timeout') or None)
-        tty.debug('DATABASE LOCK TIMEOUT: {0}s'.format(
-                  str(self.db_lock_timeout)))
-        timeout_format_str = ('{0}s'.format(str(self.package_lock_timeout))
-                              if self.package_lock_timeout else 'No timeout')
-        tty.debug('PACKAGE LOCK TIMEOUT: {0}'.format(
-                  str(timeout_format_str)))
+        if tty.is_debug():
+            tty.debug('DATABASE LOCK TIMEOUT: {0}s'.format(
+                      self.db_lock_timeout))
+            timeout_format_str = ('{0}s'.format(self.package_lock_timeout)
+                                  if self.package_lock_timeout
+                                  else 'No timeout')
+            tty.debug('PACKAGE LOCK TIMEOUT: {0}'.format(timeout_format_str))
         self.lock = Lock(self._lock_path,
                          default_timeout=self.db_lock_timeout)
         self._data = {}
 
+        # stat of the index file when it was last read or written by this
+        # process, used to skip reading it again when it did not change
+        self._index_stamp = None
+
         # whether there was an error at the start of a read transaction
         self._error = None
 
@@ -244,14 +292,16 @@ class Database(object):
         cleanup required.
         """
         prefix = spec.prefix
-        if prefix not in self._prefix_locks:
-            self._prefix_locks[prefix] = Lock(
+        lock = self._prefix_locks.get(prefix)
+        if lock is None:
+            lock = Lock(
                 self.prefix_lock_path,
                 start=spec.dag_hash_bit_prefix(bit_length(sys.maxsize)),
                 length=1,
                 default_timeout=self.package_lock_timeout)
+            self._prefix_locks[prefix] = lock
 
-        return self._prefix_locks[prefix]
+        return lock
 
     @contextlib.contextmanager
     def prefix_read_lock(self, spec):
@@ -442,8 +492,11 @@ class Database(object):
         # We do this *after* all dependencies are connected because if we
         # do it *while* we're constructing specs,it causes hashes to be
         # cached prematurely.
+        # Every node in the DAG is a record of its own, so mark the nodes
+        # one by one instead of traversing the DAG below each record.
         for hash_key, rec in data.items():
-            rec.spec._mark_concrete()
+            rec.spec._normal = True
+            rec.spec._concrete = True
 
         self._data = data
 
@@ -489,7 +542,11 @@ class Database(object):
                 # Start inspecting the installed prefixes
                 processed_specs = set()
 
-                for spec in directory_layout.all_specs():
+                all_specs = directory_layout.all_specs()
+                ctimes = _prefix_ctimes(
+                    s for s in all_specs if s.dag_hash() not in old_data)
+
+                for spec in all_specs:
                     # Try to recover explicit value from old DB, but
                     # default it to True if DB was corrupt. This is
                     # just to be conservative in case a command like
@@ -497,12 +554,12 @@ class Database(object):
                     tty.debug(
                         'RECONSTRUCTING FROM SPEC.YAML: {0}'.format(spec))
                     explicit = True
-                    inst_time = os.stat(spec.prefix).st_ctime
-                    if old_data is not None:
-                        old_info = old_data.get(spec.dag_hash())
-                        if old_info is not None:
-                            explicit = old_info.explicit
-                            inst_time = old_info.installation_time
+                    old_info = old_data.get(spec.dag_hash())
+                    if old_info is not None:
+                        explicit = old_info.explicit
+                        inst_time = old_info.installation_time
+                    else:
+                        inst_time = ctimes[spec.prefix]
 
                     extra_args = {
                         'explicit': explicit,
@@ -565,17 +622,13 @@ class Database(object):
 
         Does no locking.
         """
-        counts = {}
-        for key, rec in self._data.items():
-            counts.setdefault(key, 0)
+        counts = collections.defaultdict(int)
+        for rec in self._data.values():
             for dep in rec.spec.dependencies(_tracked_deps):
-                dep_key = dep.dag_hash()
-                counts.setdefault(dep_key, 0)
-                counts[dep_key] += 1
+                counts[dep.dag_hash()] += 1
 
-        for rec in self._data.values():
-            key = rec.spec.dag_hash()
-            expected = counts[key]
+        for key, rec in self._data.items():
+            expected = counts.get(key, 0)
             found = rec.ref_count
             if not expected == found:
                 raise AssertionError(
@@ -594,8 +647,10 @@ class Database(object):
         This routine does no locking.
 
         """
-        # Do not write if exceptions were raised
+        # Do not write if exceptions were raised. The in-memory data may
+        # be inconsistent, so make sure the next transaction reads the file.
         if type is not None:
+            self._index_stamp = None
             return
 
         temp_file = self._index_path + (
@@ -605,13 +660,35 @@ class Database(object):
         try:
             with open(temp_file, 'w') as f:
                 self._write_to_file(f)
+                # Make sure the data is on disk before the rename, or a
+                # crash could leave an empty index in place of the old one
+                f.flush()
+                os.fsync(f.fileno())
             os.rename(temp_file, self._index_path)
+            self._index_stamp = self._stat_index()
         except BaseException:
+            self._index_stamp = None
             # Clean up temp file if something goes wrong.
             if os.path.exists(temp_file):
                 os.remove(temp_file)
             raise
 
+    def _stat_index(self):
+        """Return a tuple that changes whenever the index file is replaced
+        or modified, or None if the index file cannot be stat'ed.
+        """
+        try:
+            st = os.stat(self._index_path)
+        except OSError:
+            return None
+
+        # Times in nanoseconds are only available on Python 3.3 and later.
+        # The float times can't tell apart writes close in time, and the
+        # inode of a replaced index may be reused.
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+        ctime = getattr(st, 'st_ctime_ns', st.st_ctime)
+        return (st.st_dev, st.st_ino, st.st_size, mtime, ctime)
+
     def _read(self):
         """Re-read Database from the data in the set location.
 
@@ -621,8 +698,13 @@ class Database(object):
 
         """
         if os.path.isfile(self._index_path):
-            # Read from JSON file if a JSON database exists
-            self._read_from_file(self._index_path, format='json')
+            # Read from JSON file if a JSON database exists, unless it is
+            # the same file this process last read or wrote.
+            stamp = self._stat_index()
+            if stamp is None or stamp != self._index_stamp:
+                self._index_stamp = None
+                self._read_from_file(self._index_path, format='json')
+                self._index_stamp = stamp
 
         elif os.path.isfile(self._old_yaml_index_path):
             if os.access(self._db_dir, os.R_OK | os.W_OK):
@@ -679,15 +761,43 @@ class Database(object):
         # Retrieve optional arguments
         installation_time = installation_time or _now()
 
-        for dep in spec.dependencies(_tracked_deps):
-            dkey = dep.dag_hash()
-            if dkey not in self._data:
-                extra_args = {
-                    'explicit': False,
-                    'installation_time': installation_time
-                }
-                self._add(dep, directory_layout, **extra_args)
+        # Dependencies missing from the DB are added first, deepest first
+        for dep in self._missing_dependencies(spec):
+            self._add_node(dep, directory_layout, False, installation_time)
+
+        self._add_node(spec, directory_layout, explicit, installation_time)
 
+    def _missing_dependencies(self, spec):
+        """Returns the dependencies of a spec that are not in the DB, in
+        post-order. Dependencies of specs in the DB are not visited.
+        """
+        order = []
+        visited = set()
+        stack = [(spec, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                order.append(node)
+                continue
+
+            key = node.dag_hash()
+            if key in visited:
+                continue
+            visited.add(key)
+
+            stack.append((node, True))
+            for dep in node.dependencies(_tracked_deps):
+                dkey = dep.dag_hash()
+                if dkey not in self._data and dkey not in visited:
+                    stack.append((dep, False))
+
+        # The spec itself comes last
+        return order[:-1]
+
+    def _add_node(self, spec, directory_layout, explicit, installation_time):
+        """Adds a record for a spec whose dependencies are all in the DB,
+        or marks its existing record as installed.
+        """
         key = spec.dag_hash()
         if key not in self._data:
             installed = bool(spec.external)
@@ -719,8 +829,10 @@ class Database(object):
                 self._data[dkey].ref_count += 1
 
             # Mark concrete once everything is built, and preserve
-            # the original hash of concrete specs.
-            new_spec._mark_concrete()
+            # the original hash of concrete specs. Dependencies are
+            # records of the DB already, and are concrete.
+            new_spec._normal = True
+            new_spec._concrete = True
             new_spec._hash = key
 
         else:
@@ -743,13 +855,17 @@ class Database(object):
 
     def _get_matching_spec_key(self, spec, **kwargs):
         """Get the exact spec OR get a single spec that matches."""
-        key = spec.dag_hash()
-        if key not in self._data:
-            match = self.query_one(spec, **kwargs)
-            if match:
-                return match.dag_hash()
-            raise KeyError("No such spec in database! %s" % spec)
-        return key
+        # Only hash specs that may be in the DB: hashing an abstract spec
+        # serializes it just to miss, and query_one() finds it anyway.
+        if spec.concrete or spec._hash:
+            key = spec.dag_hash()
+            if key in self._data:
+                return key
+
+        match = self.query_one(spec, **kwargs)
+        if match:
+            return match.dag_hash()
+        raise KeyError("No such spec in database! %s" % spec)
 
     @_autospec
     def get_record(self, spec, **kwargs):
@@ -757,20 +873,24 @@ class Database(object):
         return self._data[key]
 
     def _decrement_ref_count(self, spec):
-        key = spec.dag_hash()
+        # Use a worklist rather than recursion: removing a record can
+        # release its dependencies too, all the way down the DAG.
+        stack = [spec]
+        while stack:
+            spec = stack.pop()
+            key = spec.dag_hash()
 
-        if key not in self._data:
-            # TODO: print something here?  DB is corrupt, but
-            # not much we can do.
-            return
+            if key not in self._data:
+                # TODO: print something here?  DB is corrupt, but
+                # not much we can do.
+                continue
 
-        rec = self._data[key]
-        rec.ref_count -= 1
+            rec = self._data[key]
+            rec.ref_count -= 1
 
-        if rec.ref_count == 0 and not rec.installed:
-            del self._data[key]
-            for dep in spec.dependencies(_tracked_deps):
-                self._decrement_ref_count(dep)
+            if rec.ref_count == 0 and not rec.installed:
+                del self._data[key]
+                stack.extend(spec.dependencies(_tracked_deps))
 
     def _remove(self, spec):
         """Non-locking version of remove(); does real work.
@@ -823,14 +943,15 @@ class Database(object):
 
             for relative in to_add:
                 hash_key = relative.dag_hash()
-                if hash_key not in self._data:
+                rec = self._data.get(hash_key)
+                if rec is None:
                     reltype = ('Dependent' if direction == 'parents'
                                else 'Dependency')
                     tty.warn("Inconsistent state! %s %s of %s not in DB"
                              % (reltype, hash_key, spec.dag_hash()))
                     continue
 
-                if not self._data[hash_key].installed:
+                if not rec.installed:
                     continue
 
                 relatives.add(relative)
@@ -842,7 +963,7 @@ class Database(object):
         Return the specs of all packages that extend
         the given spec
         """
-        for spec in self.query():
+        for spec in self._query():
             if spec.package.extends(extendee_spec):
                 yield spec.package
 
@@ -855,7 +976,7 @@ class Database(object):
         if extensions_layout is None:
             view = YamlFilesystemView(extendee_spec.prefix, spack.store.layout)
             extensions_layout = view.extensions_layout
-        for spec in self.query():
+        for spec in self._query():
             try:
                 extensions_layout.check_activated(extendee_spec, spec)
                 yield spec.package
@@ -863,6 +984,80 @@ class Database(object):
                 continue
             # TODO: conditional way to do this instead of catching exceptions
 
+    def _query(
+            self,
+            query_spec=any,
+            known=any,
+            installed=True,
+            explicit=any,
+            start_date=None,
+            end_date=None
+    ):
+        """Run a query on the database, like query(), but without
+        sorting the results."""
+        # TODO: Specs are a lot like queries.  Should there be a
+        # TODO: wildcard spec object, and should specs have attributes
+        # TODO: like installed and known that can be queried?  Or are
+        # TODO: these really special cases that only belong here?
+        with self.read_transaction():
+            # Just look up concrete specs with hashes; no fancy search.
+            if isinstance(query_spec, spack.spec.Spec) and query_spec.concrete:
+
+                hash_key = query_spec.dag_hash()
+                if hash_key in self._data:
+                    return [self._data[hash_key].spec]
+                else:
+                    return []
+
+            # Abstract specs require more work -- currently we test
+            # against everything.
+            results = []
+            filter_dates = start_date is not None or end_date is not None
+            start_date = start_date or datetime.datetime.min
+            end_date = end_date or datetime.datetime.max
+
+            # Parse a query given as a string once, not once per record
+            if isinstance(query_spec, string_types):
+                query_spec = spack.spec.Spec(query_spec)
+
+            # Only specs with the same name can satisfy a query for a
+            # package that is not virtual, so skip others right away
+            name = None
+            if query_spec is not any and query_spec.name:
+                if not query_spec.virtual:
+                    name = query_spec.name
+
+            # spack.repo.path is a lazy singleton: look up the method
+            # through it once, not for every record
+            if known is not any:
+                exists = spack.repo.path.exists
+
+            # Filters go from the cheapest to the most expensive one
+            for key, rec in self._data.items():
+                if name is not None and rec.spec.name != name:
+                    continue
+
+                if installed is not any and rec.installed != installed:
+                    continue
+
+                if explicit is not any and rec.explicit != explicit:
+                    continue
+
+                if filter_dates:
+                    inst_date = datetime.datetime.fromtimestamp(
+                        rec.installation_time
+                    )
+                    if not (start_date < inst_date < end_date):
+                        continue
+
+                if known is not any and exists(rec.spec.name) != known:
+                    continue
+
+                if query_spec is any or rec.spec.satisfies(query_spec):
+                    results.append(rec.spec)
+
+            return results
+
     def query(
             self,
             query_spec=any,
@@ -907,47 +1102,8 @@ class Database(object):
         Returns:
             list of specs that match the query
         """
-        # TODO: Specs are a lot like queries.  Should there be a
-        # TODO: wildcard spec object, and should specs have attributes
-        # TODO: like installed and known that can be queried?  Or are
-        # TODO: these really special cases that only belong here?
-        with self.read_transaction():
-            # Just look up concrete specs with hashes; no fancy search.
-            if isinstance(query_spec, spack.spec.Spec) and query_spec.concrete:
-
-                hash_key = query_spec.dag_hash()
-                if hash_key in self._data:
-                    return [self._data[hash_key].spec]
-                else:
-                    return []
-
-            # Abstract specs require more work -- currently we test
-            # against everything.
-            results = []
-            start_date = start_date or datetime.datetime.min
-            end_date = end_date or datetime.datetime.max
-
-            for key, rec in self._data.items():
-                if installed is not any and rec.installed != installed:
-                    continue
-
-                if explicit is not any and rec.explicit != explicit:
-                    continue
-
-                if known is not any and spack.repo.path.exists(
-                        rec.spec.name) != known:
-                    continue
-
-                inst_date = datetime.datetime.fromtimestamp(
-                    rec.installation_time
-                )
-                if not (start_date < inst_date < end_date):
-                    continue
-
-                if query_spec is any or rec.spec.satisfies(query_spec):
-                    results.append(rec.spec)
-
-            return sorted(results)
+        return sorted(self._query(
+            query_spec, known, installed, explicit, start_date, end_date))
 
     def query_one(self, query_spec, known=any, installed=True):
         """Query for exactly one spec that matches the query spec.
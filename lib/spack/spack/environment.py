@@ -35,6 +35,7 @@ import subprocess
 import llnl.util.tty as tty
 
 from llnl.util.lang import dedupe
+from spack.util.environment import normalize_path
 
 
 class NameModifier(object):
@@ -98,7 +99,7 @@ class AppendPath(NameValueModifier):
         environment_value = os.environ.get(self.name, '')
         directories = environment_value.split(
             self.separator) if environment_value else []
-        directories.append(os.path.normpath(self.value))
+        directories.append(normalize_path(self.value))
         os.environ[self.name] = self.separator.join(directories)
 
 
@@ -108,7 +109,7 @@ class PrependPath(NameValueModifier):
         environment_value = os.environ.get(self.name, '')
         directories = environment_value.split(
             self.separator) if environment_value else []
-        directories = [os.path.normpath(self.value)] + directories
+        directories = [normalize_path(self.value)] + directories
         os.environ[self.name] = self.separator.join(directories)
 
 
@@ -118,8 +119,9 @@ class RemovePath(NameValueModifier):
         environment_value = os.environ.get(self.name, '')
         directories = environment_value.split(
             self.separator) if environment_value else []
-        directories = [os.path.normpath(x) for x in directories
-                       if x != os.path.normpath(self.value)]
+        value = normalize_path(self.value)
+        directories = [normalize_path(x) for x in directories
+                       if x != value]
         os.environ[self.name] = self.separator.join(directories)
 
 
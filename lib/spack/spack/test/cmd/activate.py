@@ -59,3 +59,17 @@ def test_deactivate_all(
     deactivate('--all', 'extendee')
     output = extensions('--show', 'activated', 'extendee')
     assert 'extension1' not in output
+
+
+def test_deactivate_extension_and_dependencies(
+        mock_packages, mock_archive, mock_fetch, config,
+        install_mockery):
+    install('extension2')
+    activate('extension2')
+    output = extensions('--show', 'activated', 'extendee')
+    assert 'extension1' in output and 'extension2' in output
+
+    # extension2 must be deactivated before extension1, which it needs
+    deactivate('--all', 'extension2')
+    output = extensions('--show', 'activated', 'extendee')
+    assert 'extension1' not in output and 'extension2' not in output
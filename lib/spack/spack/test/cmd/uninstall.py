@@ -23,7 +23,12 @@
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 ##############################################################################
 import pytest
+import spack.cmd
+import spack.package
 import spack.store
+from spack.cmd.uninstall import do_uninstall, get_uninstall_list
+from spack.cmd.uninstall import _installed_parents
+from spack.cmd.uninstall import find_matching_specs, installed_dependents
 from spack.main import SpackCommand, SpackCommandError
 
 uninstall = SpackCommand('uninstall')
@@ -55,6 +60,70 @@ def test_installed_dependents():
         uninstall('-y', 'libelf')
 
 
+@pytest.mark.db
+@pytest.mark.usefixtures('database')
+def test_installed_dependents_of_specs():
+    """Test that specs to be uninstalled are not their own dependents."""
+    libelf = spack.store.db.query_one('libelf')
+    libdwarf = spack.store.db.query_one('libdwarf')
+
+    dependents = installed_dependents([libelf])
+    assert libdwarf in dependents[libelf]
+    assert len(dependents[libelf]) == len(set(dependents[libelf]))
+
+    dependents = installed_dependents([libelf, libdwarf])
+    assert libdwarf not in dependents[libelf]
+    assert all(libelf not in x for x in dependents.values())
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures('database')
+def test_installed_parents():
+    """Test that dependents are found as by walking the DB for each spec."""
+    specs = spack.store.db.query()
+    parents = _installed_parents(specs)
+    for spec in specs:
+        expected = spack.store.db.installed_relatives(spec, 'parents', True)
+        assert set(parents[spec.dag_hash()].values()) == expected
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures('database')
+def test_uninstall_list_with_dependents():
+    """Test that specs to uninstall come first and only once."""
+    args = MockArgs(['libelf', 'libdwarf'], dependents=True)
+    uninstall_list = get_uninstall_list(args)
+
+    assert [x.name for x in uninstall_list[:2]] == ['libelf', 'libdwarf']
+    assert len(uninstall_list) == len(set(uninstall_list))
+    assert 'mpileaks' in [x.name for x in uninstall_list]
+
+    # Forcing the uninstall doesn't add dependents
+    args = MockArgs(['libelf', 'libdwarf'], force=True)
+    uninstall_list = get_uninstall_list(args)
+    assert [x.name for x in uninstall_list] == ['libelf', 'libdwarf']
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures('database')
+def test_uninstall_order(monkeypatch):
+    """Test that dependents are uninstalled before their dependencies."""
+    uninstalled = []
+
+    def do_uninstall_mock(pkg, force=False):
+        uninstalled.append(pkg.spec)
+    monkeypatch.setattr(
+        spack.package.PackageBase, 'do_uninstall', do_uninstall_mock)
+
+    mpileaks = spack.store.db.query_one('mpileaks ^mpich')
+    specs = sorted(mpileaks.traverse(), key=lambda s: s.name)
+    do_uninstall(specs, force=False)
+
+    assert sorted(uninstalled) == sorted(specs)
+    for i, spec in enumerate(uninstalled):
+        assert not any(spec in x.dependencies() for x in uninstalled[i:])
+
+
 @pytest.mark.db
 @pytest.mark.usefixtures('database')
 def test_recursive_uninstall():
@@ -71,3 +140,19 @@ def test_recursive_uninstall():
     assert len(mpileaks_specs) == 0
     assert len(callpath_specs) == 0
     assert len(mpi_specs) == 3
+
+
+@pytest.mark.db
+@pytest.mark.usefixtures('database')
+def test_find_matching_specs():
+    """Test matching many specs given via command line at once."""
+    specs = spack.cmd.parse_specs(['mpi', 'libelf', 'libdwarf'])
+    matching = find_matching_specs(specs, allow_multiple_matches=True)
+    expected = [spack.store.db.query(s) for s in specs]
+    assert matching == sum(expected, [])
+    assert len(matching) == 5
+
+    # Concrete specs are looked up directly
+    concrete = matching[0]
+    assert find_matching_specs([concrete]) == [concrete]
+    assert find_matching_specs([any], True) == spack.store.db.query()
@@ -22,10 +22,14 @@
 # License along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
 ##############################################################################
+import pytest
+
 from copy import copy
 from six import iteritems
 
 import spack.spec
+import spack.compilers.xl
+import spack.compilers.xl_r
 import spack.compilers as compilers
 from spack.compiler import _get_versioned_tuple, Compiler
 
@@ -246,3 +250,23 @@ def test_xl_r_flags():
     unsupported_flag_test("cxx11_flag", "xl_r@13.0")
     supported_flag_test("cxx11_flag", "-qlanglvl=extended0x", "xl_r@13.1")
     supported_flag_test("pic_flag", "-qpic", "xl_r@1.0")
+
+
+@pytest.mark.parametrize('module,compiler_cls', [
+    (spack.compilers.xl, spack.compilers.xl.Xl),
+    (spack.compilers.xl_r, spack.compilers.xl_r.XlR),
+])
+@pytest.mark.parametrize('fortran_version,version', [
+    ('16.1', '16.1'),
+    ('15.1', '13.1'),
+    ('13.1', '11.1'),
+    ('12.0', '10.0'),
+    ('11.3', '9.2'),
+    ('11.0', '8.9'),
+    ('unknown', 'unknown'),
+])
+def test_xl_fc_version(
+        module, compiler_cls, fortran_version, version, monkeypatch):
+    monkeypatch.setattr(module, 'get_compiler_version',
+                        lambda *args: fortran_version)
+    assert compiler_cls.fc_version('xlf') == version
@@ -28,13 +28,16 @@ both in memory and in its file
 """
 import datetime
 import functools
+import gc
 import multiprocessing
 import os
 import pytest
 
 from llnl.util.tty.colify import colify
 
+import spack.database
 import spack.repo
+import spack.spec
 import spack.store
 from spack.test.conftest import MockPackageMultiRepo
 from spack.util.executable import Executable
@@ -268,6 +271,18 @@ def test_015_write_and_read(database):
         assert new_rec.installed == rec.installed
 
 
+def test_016_read_from_another_instance(database):
+    """Make sure specs read from the file are whole and concrete."""
+    other = spack.database.Database(database.root)
+    with other.read_transaction():
+        specs = other.query(installed=any)
+
+    assert len(specs) == len(database.query(installed=any))
+    for spec in specs:
+        assert all(s.concrete for s in spec.traverse())
+        assert spec == database.get_record(spec).spec
+
+
 def test_020_db_sanity(database):
     """Make sure query() returns what's actually in the db."""
     _check_db_sanity(database)
@@ -279,6 +294,21 @@ def test_025_reindex(database):
     _check_db_sanity(database)
 
 
+def test_026_reindex_without_old_data(mutable_database):
+    """Make sure installation times come from prefixes with no old DB."""
+    os.remove(mutable_database._index_path)
+    mutable_database._data = {}
+
+    spack.store.store.reindex()
+    _check_db_sanity(mutable_database)
+
+    # Dependencies added along with a spec get the time of that spec
+    specs = mutable_database.query()
+    ctimes = set(os.stat(s.prefix).st_ctime for s in specs if not s.external)
+    for spec in specs:
+        assert mutable_database.get_record(spec).installation_time in ctimes
+
+
 def test_030_db_sanity_from_another_process(mutable_database):
     def read_and_modify():
         # check that other process can read DB
@@ -295,6 +325,90 @@ def test_030_db_sanity_from_another_process(mutable_database):
         assert len(mutable_database.query('mpileaks ^zmpi')) == 0
 
 
+def test_035_read_index_only_when_changed(mutable_database, monkeypatch):
+    """Ensure the index is not parsed again unless its file changed."""
+    read_from_file = mutable_database._read_from_file
+    calls = []
+
+    def counting_read_from_file(*args, **kwargs):
+        calls.append(args)
+        return read_from_file(*args, **kwargs)
+
+    monkeypatch.setattr(
+        mutable_database, '_read_from_file', counting_read_from_file)
+
+    with mutable_database.read_transaction():
+        pass
+    del calls[:]
+
+    with mutable_database.read_transaction():
+        assert len(mutable_database.query('mpileaks ^zmpi')) == 1
+    with mutable_database.write_transaction():
+        pass
+    with mutable_database.read_transaction():
+        pass
+    assert not calls
+
+    # another instance writing the index must make this one read it again
+    other = spack.database.Database(mutable_database.root)
+    with other.write_transaction():
+        other.remove('mpileaks ^zmpi')
+
+    with mutable_database.read_transaction():
+        assert len(mutable_database.query('mpileaks ^zmpi')) == 0
+    assert len(calls) == 1
+
+
+def test_035_read_index_rewritten_in_place(mutable_database, monkeypatch):
+    """Ensure the index is read again when it is rewritten with the same
+    size, without going through the Database."""
+    with mutable_database.read_transaction():
+        pass
+
+    calls = []
+    read_from_file = mutable_database._read_from_file
+
+    def counting_read_from_file(*args, **kwargs):
+        calls.append(args)
+        return read_from_file(*args, **kwargs)
+
+    monkeypatch.setattr(
+        mutable_database, '_read_from_file', counting_read_from_file)
+
+    index_path = mutable_database._index_path
+    with open(index_path) as f:
+        index = f.read()
+    size = os.path.getsize(index_path)
+    with open(index_path, 'w') as f:
+        f.write(index)
+    assert os.path.getsize(index_path) == size
+
+    with mutable_database.read_transaction():
+        pass
+    assert len(calls) == 1
+
+
+def test_036_write_reuses_spec_dicts(mutable_database, monkeypatch):
+    """Ensure specs are converted to dictionaries once for all writes."""
+    with mutable_database.write_transaction():
+        pass
+
+    records = mutable_database._data.values()
+    expected = dict((r.spec.dag_hash(), r.spec.to_node_dict())
+                    for r in records)
+
+    def fail_to_node_dict(self, hash_function=None):
+        raise AssertionError('spec dictionary computed again')
+
+    monkeypatch.setattr(spack.spec.Spec, 'to_node_dict', fail_to_node_dict)
+    with mutable_database.write_transaction():
+        pass
+    monkeypatch.undo()
+
+    for rec in records:
+        assert rec.to_dict()['spec'] == expected[rec.spec.dag_hash()]
+
+
 def test_040_ref_counts(database):
     """Ensure that we got ref counts right when we read the DB."""
     database._check_ref_counts()
@@ -328,6 +442,10 @@ def test_050_basic_query(database):
     assert len(database.query('mpileaks ^mpich2')) == 1
     assert len(database.query('mpileaks ^zmpi')) == 1
 
+    # Query by whether packages are known to the repository
+    assert len(database.query(known=True)) == 16
+    assert len(database.query(known=False)) == 0
+
     # Query by date
     assert len(database.query(start_date=datetime.datetime.min)) == 16
     assert len(database.query(start_date=datetime.datetime.max)) == 0
@@ -469,3 +587,33 @@ def test_regression_issue_8036(mutable_database, usr_folder_exists):
     # Now install the external package and check again the `installed` property
     s.package.do_install(fake=True)
     assert s.package.installed
+
+
+def test_prefix_locks_kept_while_referenced(database):
+    spec = database.query_one('mpileaks ^mpich')
+
+    lock = database.prefix_lock(spec)
+    assert database.prefix_lock(spec) is lock
+    with database.prefix_write_lock(spec):
+        assert database.prefix_lock(spec) is lock
+
+    del lock
+    gc.collect()
+    assert spec.prefix not in database._prefix_locks
+
+
+def test_missing_dependencies_in_post_order(mutable_database, tmpdir):
+    spec = mutable_database.query_one('mpileaks ^mpich')
+    tracked = ('link', 'run')
+
+    # Nothing is missing from the database the spec comes from
+    assert mutable_database._missing_dependencies(spec) == []
+
+    # In an empty database, every dependency is missing and comes after
+    # all of its own dependencies
+    empty = spack.database.Database(str(tmpdir.join('empty')))
+    missing = empty._missing_dependencies(spec)
+    expected = list(spec.traverse(root=False, deptype=tracked))
+    assert sorted(missing) == sorted(expected)
+    for i, dep in enumerate(missing):
+        assert all(d in missing[:i] for d in dep.dependencies(tracked))
@@ -31,6 +31,7 @@ from spack.environment import EnvironmentModifications
 from spack.environment import RemovePath, PrependPath, AppendPath
 from spack.environment import SetEnv, UnsetEnv
 from spack.util.environment import filter_system_paths, is_system_path
+from spack.util.environment import normalize_path
 
 
 def test_inspect_path(tmpdir):
@@ -190,6 +191,16 @@ def test_filter_system_paths(miscellaneous_paths):
     assert filtered == expected
 
 
+@pytest.mark.parametrize('path', [
+    '', '.', '..', '/', '//', '///', '/usr/lib', '/usr/lib/', 'usr//lib',
+    './usr', '../usr', '/usr/./lib', '/usr/../lib', '/usr/..', '.hidden',
+    '/usr/.hidden/..lib', 'usr/lib/.',
+])
+def test_normalize_path(path):
+    """Tests that normalizing paths gives the same result as normpath."""
+    assert normalize_path(path) == os.path.normpath(path)
+
+
 def test_set_path(env):
     """Tests setting paths in an environment variable."""
 
@@ -30,6 +30,8 @@ import pytest
 
 from llnl.util.filesystem import LibraryList, HeaderList
 from llnl.util.filesystem import find_libraries, find_headers, find
+from llnl.util.filesystem import find_system_libraries
+import llnl.util.filesystem as fs
 
 import spack.paths
 
@@ -107,6 +109,9 @@ class TestLibraryList(object):
         assert isinstance(ld_flags, str)
         assert ld_flags == search_flags + ' ' + link_flags
 
+        assert LibraryList([]).search_flags == ''
+        assert LibraryList([]).link_flags == ''
+
     def test_paths_manipulation(self, library_list):
         names = library_list.names
         assert names == ['lapack', 'python3.6', 'blas', 'z', 'mpi']
@@ -114,6 +119,12 @@ class TestLibraryList(object):
         directories = library_list.directories
         assert directories == ['/dir1', '/dir2', '/dir3']
 
+        # Modifying the lists returned doesn't change the cached ones
+        names.append('foo')
+        directories.append('/foo')
+        assert 'foo' not in library_list.names
+        assert '/foo' not in library_list.directories
+
     def test_get_item(self, library_list):
         a = library_list[0]
         assert a == '/dir1/liblapack.a'
@@ -140,6 +151,11 @@ class TestLibraryList(object):
         assert type(library_list + pylist) == type(library_list)
         assert type(pylist + library_list) == type(library_list)
 
+    def test_contains(self, library_list):
+        assert '/dir1/libblas.a' in library_list
+        assert '/dir1/libz.so' not in library_list
+        assert '/dir4/libnew.a' in library_list + ['/dir4/libnew.a']
+
 
 class TestHeaderList(object):
 
@@ -297,3 +313,103 @@ def test_searching_order(search_fn, search_list, root, kwargs):
 def test_find_with_globbing(root, search_list, kwargs, expected):
     matches = find(root, search_list, **kwargs)
     assert sorted(matches) == sorted(expected)
+
+
+@pytest.mark.parametrize('recursive', [True, False])
+def test_find_hidden_files(tmpdir, recursive):
+    tmpdir.ensure('libfoo.so')
+    tmpdir.ensure('.libfoo.so')
+
+    root = str(tmpdir)
+    assert find(root, '*.so', recursive) == [
+        os.path.join(root, 'libfoo.so')
+    ]
+    assert find(root, '.*.so', recursive) == [
+        os.path.join(root, '.libfoo.so')
+    ]
+
+
+def test_find_non_existing_root(tmpdir):
+    root = str(tmpdir.join('missing'))
+    assert find(root, '*.so', recursive=False) == []
+    assert find(root, '*.so', recursive=True) == []
+
+
+@pytest.mark.parametrize('recursive', [True, False])
+def test_find_literal_names(tmpdir, recursive):
+    tmpdir.ensure('libfoo.so')
+    tmpdir.ensure('libfoo.so.1')
+    tmpdir.ensure('.libfoo.so')
+    tmpdir.ensure('lib', 'libbaz.so')
+
+    root = str(tmpdir)
+    assert find(root, 'libfoo.so', recursive) == [
+        os.path.join(root, 'libfoo.so')
+    ]
+    assert find(root, 'libbar.so', recursive) == []
+    assert find(root, ['.libfoo.so', 'lib/libbaz.so'], recursive) == [
+        os.path.join(root, '.libfoo.so'),
+        os.path.join(root, 'lib', 'libbaz.so')
+    ]
+
+
+@pytest.mark.parametrize('recursive', [True, False])
+def test_find_overlapping_patterns(tmpdir, recursive):
+    tmpdir.ensure('libfoo.so')
+    tmpdir.ensure('libfoo.a')
+    tmpdir.ensure('README')
+
+    root = str(tmpdir)
+    so, a = os.path.join(root, 'libfoo.so'), os.path.join(root, 'libfoo.a')
+    assert find(root, ['*.so', 'lib*.so', '*.a'], recursive) == [so, so, a]
+    assert find(root, ['*.a', 'sub/*.so'], recursive) == [a]
+
+
+def test_find_system_libraries(tmpdir, monkeypatch):
+    locations = [str(tmpdir.join(x)) for x in ('lib64', 'usr/lib', 'lib')]
+    tmpdir.ensure('lib64/libbar.so')
+    tmpdir.ensure('lib64/sub', dir=True)
+    tmpdir.ensure('usr/lib/x86_64-linux-gnu/libfoo.so')
+    tmpdir.ensure('lib/libfoo.so')
+
+    def age(path):
+        # Results are only cached once the directories are old enough
+        for root, _, _ in os.walk(path):
+            os.utime(root, (1500000000, 1500000000))
+
+    age(str(tmpdir))
+    monkeypatch.setattr(fs, '_system_library_locations', locations)
+    monkeypatch.setattr(fs, '_system_libraries_cache', {})
+
+    # The first location with results wins for each library
+    libraries = find_system_libraries(['libfoo', 'libbaz', 'libbar'])
+    assert list(libraries) == [
+        str(tmpdir.join('usr/lib/x86_64-linux-gnu/libfoo.so')),
+        str(tmpdir.join('lib64/libbar.so'))
+    ]
+    libraries = find_system_libraries('libbaz')
+    assert isinstance(libraries, LibraryList) and not libraries
+
+    # Results are reused until one of the directories is modified
+    tmpdir.ensure('lib64/libfoo.so')
+    age(str(tmpdir.join('lib64')))
+    libraries = find_system_libraries(['libfoo', 'libbaz', 'libbar'])
+    assert list(libraries)[0] == str(
+        tmpdir.join('usr/lib/x86_64-linux-gnu/libfoo.so'))
+
+    # Including directories below the locations
+    tmpdir.ensure('lib64/sub/libfoo.so')
+    libraries = find_system_libraries(['libfoo', 'libbaz', 'libbar'])
+    assert list(libraries) == [
+        str(tmpdir.join('lib64/libfoo.so')),
+        str(tmpdir.join('lib64/sub/libfoo.so')),
+        str(tmpdir.join('lib64/libbar.so'))
+    ]
+
+
+@pytest.mark.parametrize('search_fn', [find_libraries, find_headers])
+def test_find_wrong_argument_type(search_fn):
+    with pytest.raises(TypeError, match=search_fn.__name__):
+        search_fn(1, '/')
+
+    assert len(search_fn(('libfoo', 'libbar'), '/missing')) == 0
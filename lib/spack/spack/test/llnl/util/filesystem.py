@@ -26,6 +26,7 @@
 
 import llnl.util.filesystem as fs
 import os
+import shutil
 import stat
 import pytest
 
@@ -76,6 +77,31 @@ class TestCopy:
 
             assert os.path.exists('dest/1')
 
+    def test_content(self, stage):
+        """Test that the content of the file is copied."""
+
+        with fs.working_dir(str(stage)):
+            with open('source/1', 'w') as f:
+                f.write('Some content.')
+
+            fs.copy('source/1', 'dest/1')
+
+            with open('dest/1') as f:
+                assert f.read() == 'Some content.'
+
+    def test_same_file(self, stage):
+        """Test that copying a file onto itself doesn't truncate it."""
+
+        with fs.working_dir(str(stage)):
+            with open('source/1', 'w') as f:
+                f.write('Some content.')
+
+            with pytest.raises(shutil.Error):
+                fs.copy('source/1', 'source/1')
+
+            with open('source/1') as f:
+                assert f.read() == 'Some content.'
+
 
 def check_added_exe_permissions(src, dst):
     src_mode = os.stat(src).st_mode
@@ -162,6 +188,41 @@ class TestCopyTree:
             assert os.path.exists('dest/2')
             assert not os.path.islink('dest/2')
 
+    def test_symlinks_redirection(self, stage):
+        """Test that only links pointing into the source are redirected."""
+
+        with fs.working_dir(str(stage)):
+            fs.touchp('sou.rce/1')
+            fs.touchp('sourxce/1')
+            os.symlink(os.path.abspath('sou.rce/1'), 'sou.rce/inside')
+            os.symlink(os.path.abspath('sourxce/1'), 'sou.rce/outside')
+
+            fs.copy_tree('sou.rce', 'dest', symlinks=True)
+
+            assert os.readlink('dest/inside') == os.path.abspath('dest/1')
+            assert (os.readlink('dest/outside') ==
+                    os.path.abspath('sourxce/1'))
+
+    def test_parallel(self, stage, monkeypatch):
+        """Test copying files with a pool of threads."""
+        monkeypatch.setattr(fs, '_copy_tree_parallel_threshold', 1)
+
+        with fs.working_dir(str(stage)):
+            fs.copy_tree('source', 'dest')
+
+            assert os.path.exists('dest/c/d/e/7')
+            assert os.path.islink('dest/2')
+
+    def test_error_in_pool(self, stage, monkeypatch):
+        """Test that errors raised while copying files are propagated."""
+        monkeypatch.setattr(fs, '_copy_tree_parallel_threshold', 1)
+
+        with fs.working_dir(str(stage)):
+            fs.mkdirp('dest/c/d/5')
+
+            with pytest.raises(IOError):
+                fs.copy_tree('source', 'dest')
+
 
 class TestInstallTree:
     """Tests for ``filesystem.install_tree``"""
@@ -201,6 +262,73 @@ class TestInstallTree:
             assert not os.path.islink('dest/2')
 
 
+def test_mkdirp(tmpdir):
+    path = str(tmpdir.join('a', 'b'))
+
+    fs.mkdirp(path)
+    assert os.path.isdir(path)
+
+    # Creating an existing directory is fine
+    fs.mkdirp(path)
+    assert os.path.isdir(path)
+
+    # Creating a directory over a file is not
+    fs.touch(str(tmpdir.join('file')))
+    with pytest.raises(OSError):
+        fs.mkdirp(str(tmpdir.join('file')))
+
+
+def test_force_remove(tmpdir):
+    fs.touch(str(tmpdir.join('file')))
+    fs.mkdirp(str(tmpdir.join('dir')))
+
+    fs.force_remove(str(tmpdir.join('file')),
+                    str(tmpdir.join('missing')),
+                    str(tmpdir.join('dir')))
+
+    assert not os.path.exists(str(tmpdir.join('file')))
+    assert os.path.isdir(str(tmpdir.join('dir')))
+
+    # A path through a regular file doesn't exist either
+    fs.touch(str(tmpdir.join('file')))
+    fs.force_remove(str(tmpdir.join('file', 'sub')))
+    assert os.path.isfile(str(tmpdir.join('file')))
+
+
+@pytest.mark.parametrize('scandir', [True, False])
+@pytest.mark.parametrize('threshold', [1, 16])
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_walk_parallel(stage, jobs, threshold, scandir, monkeypatch):
+    """Test that walking with threads gives the same result as os.walk."""
+
+    monkeypatch.setattr(fs, '_walk_parallel_threshold', threshold)
+    if not scandir:
+        monkeypatch.setattr(fs, '_scandir', None)
+
+    with fs.working_dir(str(stage)):
+        os.symlink('missing', 'source/c/broken')
+        fs.touchp('source/c/d/e/f/8')
+        assert fs._walk_parallel('source', jobs) == list(os.walk('source'))
+
+
+@pytest.mark.parametrize('threshold', [1, 16])
+def test_walk_parallel_error(stage, threshold, monkeypatch):
+    """Test that errors other than OSError in a thread reach the caller."""
+
+    list_directory = fs._list_directory
+
+    def _list_directory(path):
+        if os.path.basename(path) == 'c':
+            raise ValueError(path)
+        return list_directory(path)
+
+    monkeypatch.setattr(fs, '_walk_parallel_threshold', threshold)
+    monkeypatch.setattr(fs, '_list_directory', _list_directory)
+    with fs.working_dir(str(stage)):
+        with pytest.raises(ValueError):
+            fs._walk_parallel('source', 4)
+
+
 def test_move_transaction_commit(tmpdir):
 
     fake_library = tmpdir.mkdir('lib').join('libfoo.so')
@@ -234,3 +362,119 @@ def test_move_transaction_rollback(tmpdir):
         pass
 
     assert h == fs.hash_directory(str(tmpdir))
+
+
+def test_hash_directory_accounts_for_file_names(tmpdir):
+
+    fake_library = tmpdir.mkdir('lib').join('libfoo.so')
+    fake_library.write('Just some fake content.')
+
+    h = fs.hash_directory(str(tmpdir))
+
+    fake_library.move(tmpdir.join('lib', 'libbar.so'))
+
+    assert h != fs.hash_directory(str(tmpdir))
+
+
+class TestFilterFile:
+    """Tests for ``filesystem.filter_file``"""
+
+    @pytest.fixture(autouse=True, params=['in_memory', 'streaming'])
+    def filter_mode(self, request, monkeypatch):
+        if request.param == 'streaming':
+            monkeypatch.setattr(fs, '_filter_in_memory_size', -1)
+        return request.param
+
+    @pytest.fixture()
+    def script(self, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('#!/bin/bash\nfoo=1\nbar=foo.2\n')
+        script.chmod(0o755)
+        return script
+
+    def test_regex(self, script):
+        fs.filter_file(r'^(\w+)=', r'export \1=', str(script))
+
+        assert script.read() == '#!/bin/bash\nexport foo=1\nexport bar=foo.2\n'
+
+    def test_string(self, script):
+        fs.filter_file('foo.', 'baz', str(script), string=True)
+
+        assert script.read() == '#!/bin/bash\nfoo=1\nbar=baz2\n'
+
+    def test_callable(self, script):
+        fs.filter_file(r'\d', lambda m: str(2 * int(m.group(0))), str(script))
+
+        assert script.read() == '#!/bin/bash\nfoo=2\nbar=foo.4\n'
+
+    def test_backup(self, script):
+        fs.filter_file('bar', 'baz', str(script))
+        fs.filter_file('foo', 'qux', str(script))
+
+        assert script.read() == '#!/bin/bash\nqux=1\nbaz=qux.2\n'
+        with open(str(script) + '~') as f:
+            assert f.read() == '#!/bin/bash\nfoo=1\nbar=foo.2\n'
+
+    def test_no_backup(self, script):
+        fs.filter_file('bar', 'baz', str(script), backup=False)
+
+        assert script.read() == '#!/bin/bash\nfoo=1\nbaz=foo.2\n'
+        assert not os.path.exists(str(script) + '~')
+
+    def test_mode_is_preserved(self, script):
+        fs.filter_file('bar', 'baz', str(script))
+
+        assert stat.S_IMODE(os.stat(str(script)).st_mode) == 0o755
+
+    def test_failure_leaves_file_untouched(self, script):
+        def fail(match):
+            raise ValueError('cannot replace')
+
+        with pytest.raises(ValueError):
+            fs.filter_file('bar', fail, str(script), backup=False)
+
+        assert script.read() == '#!/bin/bash\nfoo=1\nbar=foo.2\n'
+        assert os.listdir(script.dirname) == ['script.sh']
+
+    def test_no_trailing_newline(self, tmpdir):
+        script = tmpdir.join('script.sh')
+        script.write('foo\n\nbar')
+
+        fs.filter_file('bar', 'baz', str(script))
+
+        assert script.read() == 'foo\n\nbaz\n'
+
+    def test_unchanged_file(self, script, filter_mode):
+        inode = os.stat(str(script)).st_ino
+
+        fs.filter_file('missing', 'baz', str(script))
+
+        assert script.read() == '#!/bin/bash\nfoo=1\nbar=foo.2\n'
+        if filter_mode == 'in_memory':
+            assert os.stat(str(script)).st_ino == inode
+
+    def test_ignore_absent(self, tmpdir):
+        missing = str(tmpdir.join('missing'))
+
+        fs.filter_file('foo', 'bar', missing, ignore_absent=True)
+
+        assert not os.path.exists(missing)
+
+
+def test_change_sed_delimiter(tmpdir):
+    script = tmpdir.join('script.sh')
+    script.write('\n'.join([
+        's/foo/bar/g',
+        "sed -e 's/a/b c/' file",
+        'sed -e "s/x/y/p" -e \'s/1/2/\' file',
+        'echo s/not/a/command',
+    ]) + '\n')
+
+    fs.change_sed_delimiter('/', '@', str(script))
+
+    assert script.read() == '\n'.join([
+        's@foo@bar@g',
+        "sed -e 's@a@b c@g' file",
+        'sed -e "s@x@y@g" -e \'s@1@2@g\' file',
+        'echo s/not/a/command',
+    ]) + '\n'
@@ -0,0 +1,61 @@
+##############################################################################
+# Copyright (c) 2013-2018, Lawrence Livermore National Security, LLC.
+# Produced at the Lawrence Livermore National Laboratory.
+#
+# This file is part of Spack.
+# Created by Todd Gamblin, tgamblin@llnl.gov, All rights reserved.
+# LLNL-CODE-647188
+#
+# For details, see https://github.com/spack/spack
+# Please also see the NOTICE and LICENSE files for our notice and the LGPL.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License (as
+# published by the Free Software Foundation) version 2.1, February 1999.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the IMPLIED WARRANTY OF
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the terms and
+# conditions of the GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public
+# License along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##############################################################################
+from six import StringIO
+
+import spack.util.spack_json as sjson
+
+
+data = {
+    'database': {
+        'installs': {
+            'abcdef': {
+                'spec': {'zlib': {'version': '1.2.11', 'shared': True}},
+                'ref_count': 1,
+                'installed': True,
+                'path': None,
+                'deps': ['a', 'b'],
+            }
+        },
+        'version': '0.9.3'
+    }
+}
+
+
+def test_dump_and_load_string():
+    """Test that data is read back the same from a JSON string."""
+    text = sjson.dump(data)
+    assert sjson.load(text) == data
+
+
+def test_dump_and_load_stream():
+    """Test that dumping to a stream writes the same as dumping a string."""
+    stream = StringIO()
+    assert sjson.dump(data, stream) is None
+    assert stream.getvalue() == sjson.dump(data)
+
+    stream.seek(0)
+    loaded = sjson.load(stream)
+    assert loaded == data
+    assert all(type(x) is str for x in loaded['database'])
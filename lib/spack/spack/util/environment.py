@@ -24,6 +24,7 @@
 ##############################################################################
 import contextlib
 import os
+import re
 
 
 system_paths = ['/', '/usr', '/usr/local']
@@ -32,6 +33,19 @@ system_dirs = [os.path.join(p, s) for s in suffixes for p in system_paths] + \
     system_paths
 
 
+#: Matches the paths that ``os.path.normpath`` may change
+_unnormalized_path_regex = re.compile(r'//|(?:^|/)\.\.?(?:/|$)|[^/]/$')
+
+
+def normalize_path(path):
+    """Same as ``os.path.normpath(path)``, but returns the path itself
+    if it is already normalized, as most of the paths we get are.
+    """
+    if path and not _unnormalized_path_regex.search(path):
+        return path
+    return os.path.normpath(path)
+
+
 def is_system_path(path):
     """Predicate that given a path returns True if it is a system path,
     False otherwise.
@@ -42,7 +56,7 @@ def is_system_path(path):
     Returns:
         True or False
     """
-    return os.path.normpath(path) in system_dirs
+    return normalize_path(path) in system_dirs
 
 
 def filter_system_paths(paths):
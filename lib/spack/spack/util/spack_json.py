@@ -45,15 +45,22 @@ def load(stream):
     else:
         load = json.load
 
+    # Strings are already str in python 3, so there is nothing to convert
+    if sys.version_info[0] >= 3:
+        return load(stream)
+
     return _strify(load(stream, object_hook=_strify), ignore_dicts=True)
 
 
 def dump(data, stream=None):
     """Dump JSON with a reasonable amount of indentation and separation."""
+    # json.dump() writes each small chunk of the output separately: encode
+    # everything first and write it to the stream at once
+    text = json.dumps(data, **_json_dump_args)
     if stream is None:
-        return json.dumps(data, **_json_dump_args)
+        return text
     else:
-        return json.dump(data, stream, **_json_dump_args)
+        stream.write(text)
 
 
 def _strify(data, ignore_dicts=False):